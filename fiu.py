@@ -1,8 +1,16 @@
 # main.py - Discord Bot with PostgreSQL + JSONBin.io for persistent token storage
 import os
 import json
+import hashlib
+import sqlite3
+import sys
+import signal
+import atexit
 import asyncio
 import threading
+import functools
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 import discord
 import aiohttp
 import requests
@@ -11,12 +19,17 @@ from flask import Flask, request
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 import time
+import random
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
 from PIL import Image, ImageDraw
 import io
 
 # Try to import psycopg2, fallback to JSONBin if not available
 try:
     import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
     HAS_PSYCOPG2 = True
     print("✅ psycopg2 imported successfully")
 except ImportError:
@@ -33,6 +46,65 @@ DATABASE_URL = os.getenv('DATABASE_URL')
 # JSONBin.io configuration
 JSONBIN_API_KEY = os.getenv('JSONBIN_API_KEY')  # Thêm vào .env file
 JSONBIN_BIN_ID = os.getenv('JSONBIN_BIN_ID')    # Thêm vào .env file
+JSONBIN_FLUSH_DELAY = float(os.getenv('JSONBIN_FLUSH_DELAY', 2))   # Giây gom các thay đổi trước khi PUT một lần
+JSONBIN_SNAPSHOT_TTL = float(os.getenv('JSONBIN_SNAPSHOT_TTL', 300))   # Giây trước khi snapshot cục bộ được tải lại
+
+# Database connection pool configuration
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 5))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))          # Số giây tối đa chờ một connection rảnh
+DB_POOL_IDLE_CHECK = float(os.getenv('DB_POOL_IDLE_CHECK', 30))    # Connection rảnh lâu hơn mức này sẽ được kiểm tra lại
+DB_BULK_BATCH_SIZE = int(os.getenv('DB_BULK_BATCH_SIZE', 500))     # Số dòng mỗi lệnh INSERT nhiều dòng
+
+# Số thread chạy các thao tác lưu trữ blocking (psycopg2, requests, file) ngoài event loop
+STORAGE_WORKERS = int(os.getenv('STORAGE_WORKERS', 4))
+
+# Local token store (SQLite WAL thay cho tokens.json)
+LOCAL_TOKEN_DB = os.getenv('LOCAL_TOKEN_DB', 'tokens.db')
+LEGACY_TOKENS_JSON = 'tokens.json'
+JOB_DB = os.getenv('JOB_DB', 'jobs.db')   # Hàng đợi tác vụ hàng loạt (deploy, invite, tạo kênh...)
+
+# Avatar cache cho roster
+AVATAR_CACHE_DIR = os.getenv('AVATAR_CACHE_DIR', 'avatar_cache')
+AVATAR_CACHE_SIZE = int(os.getenv('AVATAR_CACHE_SIZE', 256))   # Số ảnh đã decode giữ trong RAM
+AVATAR_FETCH_TIMEOUT = float(os.getenv('AVATAR_FETCH_TIMEOUT', 3))   # Giây chờ tối đa cho mỗi avatar từ CDN
+ROSTER_RENDER_WORKERS = int(os.getenv('ROSTER_RENDER_WORKERS', 2))           # Thread ghép / encode ảnh roster
+ROSTER_RENDER_CONCURRENCY = int(os.getenv('ROSTER_RENDER_CONCURRENCY', 2))   # Số trang được render cùng lúc
+ROSTER_PAGE_CACHE_SIZE = int(os.getenv('ROSTER_PAGE_CACHE_SIZE', 64))         # Số trang roster đã render giữ trong RAM
+
+# Ghi song song vào các tầng lưu trữ
+TIER_WRITE_TIMEOUTS = {
+    'db': float(os.getenv('TIER_WRITE_TIMEOUT_DB', 5)),
+    'jsonbin': float(os.getenv('TIER_WRITE_TIMEOUT_JSONBIN', 10)),
+    'local': float(os.getenv('TIER_WRITE_TIMEOUT_LOCAL', 2)),
+}
+TIER_WRITE_RETRIES = int(os.getenv('TIER_WRITE_RETRIES', 3))
+
+# Background storage health checks
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', 60))
+
+# Shared HTTP client cho các lời gọi REST trực tiếp
+DISCORD_API_BASE = "https://discord.com/api/v10"
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 30))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 15))
+
+# Thêm member hàng loạt
+MEMBER_ADD_CONCURRENCY = int(os.getenv('MEMBER_ADD_CONCURRENCY', 5))   # Số request thêm member chạy đồng thời
+MEMBER_ADD_MAX_429_RETRIES = int(os.getenv('MEMBER_ADD_MAX_429_RETRIES', 5))
+MEMBER_ADD_MAX_RETRIES = int(os.getenv('MEMBER_ADD_MAX_RETRIES', 3))          # Số lần thử lại lỗi tạm thời (5xx, mất kết nối)
+MEMBER_ADD_BACKOFF_BASE = float(os.getenv('MEMBER_ADD_BACKOFF_BASE', 1))
+MEMBER_ADD_BACKOFF_MAX = float(os.getenv('MEMBER_ADD_BACKOFF_MAX', 30))
+GUILD_BREAKER_THRESHOLD = int(os.getenv('GUILD_BREAKER_THRESHOLD', 3))        # Số lỗi liên tiếp của một server trước khi ngắt
+GUILD_BREAKER_COOLDOWN = float(os.getenv('GUILD_BREAKER_COOLDOWN', 300))      # Giây ngắt trước khi cho thử lại
+CHANNEL_CREATE_CONCURRENCY = int(os.getenv('CHANNEL_CREATE_CONCURRENCY', 5))  # Số server tạo kênh đồng thời
+DISCORD_GLOBAL_RATE_LIMIT = int(os.getenv('DISCORD_GLOBAL_RATE_LIMIT', 50))   # Request/giây cho toàn bộ bot
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', 3))   # Giây tối thiểu giữa 2 lần sửa tin nhắn tiến độ
+
+# Token cache configuration
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1000))
+TOKEN_CACHE_TTL = float(os.getenv('TOKEN_CACHE_TTL', 600))                   # Giây giữ một token đã tìm thấy
+TOKEN_CACHE_NEGATIVE_TTL = float(os.getenv('TOKEN_CACHE_NEGATIVE_TTL', 60))   # Giây nhớ user chưa ủy quyền
 
 if not DISCORD_TOKEN:
     exit("LỖI: Không tìm thấy DISCORD_TOKEN")
@@ -51,12 +123,41 @@ RENDER_URL = os.getenv('RENDER_EXTERNAL_URL', f'http://127.0.0.1:{PORT}')
 REDIRECT_URI = f'{RENDER_URL}/callback'
 
 # --- JSONBIN.IO FUNCTIONS ---
+class StorageUnavailable(Exception):
+    """Một tầng lưu trữ không trả lời được (khác với 'không có dữ liệu')"""
+
+WRITE_QUEUED = 'queued'   # Kết quả ghi: thay đổi mới vào hàng đợi write-behind, chưa PUT xong
+
 class JSONBinStorage:
-    def __init__(self):
+    def __init__(self, flush_delay=JSONBIN_FLUSH_DELAY, snapshot_ttl=JSONBIN_SNAPSHOT_TTL):
         self.api_key = JSONBIN_API_KEY
         self.bin_id = JSONBIN_BIN_ID
         self.base_url = "https://api.jsonbin.io/v3"
         
+        # Snapshot cục bộ của bản ghi, mọi lần đọc đều phục vụ từ bộ nhớ
+        self.snapshot_ttl = snapshot_ttl
+        self._snapshot = None
+        self._snapshot_meta = {}
+        self._snapshot_at = 0.0
+        self._snapshot_generation = 0             # Tăng mỗi lần snapshot được thay sau khi ghi
+        self._snapshot_lock = threading.Lock()    # Chỉ giữ khi đọc / thay snapshot, không bao giờ giữ qua request mạng
+        self._refresh_lock = threading.Lock()     # Chỉ một lần tải lại tại một thời điểm
+        self.snapshot_hits = 0
+        self.snapshot_refreshes = 0
+        self.last_refresh_ok = None
+        
+        # Write-behind: các thay đổi đang chờ được gom lại và ghi bằng một lần PUT
+        self.flush_delay = flush_delay
+        self._pending = {}                    # user_id -> bản ghi mới, hoặc None nếu cần xóa
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()   # Chỉ một lần đọc-sửa-ghi bin tại một thời điểm
+        self._flush_timer = None
+        self._closed = False
+        self.queued_count = 0
+        self.flushed_count = 0
+        self.flush_count = 0
+        self.failed_flush_count = 0
+        
     def _get_headers(self):
         """Tạo headers cho requests"""
         return {
@@ -74,12 +175,14 @@ class JSONBinStorage:
             response = requests.post(
                 f"{self.base_url}/b",
                 json=data,
-                headers=self._get_headers()
+                headers=self._get_headers(),
+                timeout=HTTP_TIMEOUT
             )
             
             if response.status_code == 200:
                 result = response.json()
                 self.bin_id = result['metadata']['id']
+                self._set_snapshot(data, result.get('metadata', {}))
                 print(f"✅ Created new JSONBin: {self.bin_id}")
                 print(f"🔑 Add this to your .env: JSONBIN_BIN_ID={self.bin_id}")
                 return self.bin_id
@@ -90,32 +193,122 @@ class JSONBinStorage:
             print(f"❌ JSONBin create error: {e}")
             return None
     
-    def read_data(self):
-        """Đọc dữ liệu từ JSONBin"""
+    def read_data(self, strict=False):
+        """
+        Đọc dữ liệu từ snapshot cục bộ (đã bao gồm các thay đổi chưa kịp ghi).
+        Chưa từng tải được bin: trả về {} hoặc ném StorageUnavailable nếu `strict`.
+        """
+        snapshot = self._get_snapshot()
+        if snapshot is None:
+            if strict:
+                raise StorageUnavailable("JSONBin snapshot unavailable")
+            snapshot = {}
+        return self._apply_pending(dict(snapshot))
+    
+    def refresh(self):
+        """Bắt buộc tải lại snapshot từ JSONBin, trả về False nếu không tải được"""
+        with self._refresh_lock:
+            return self._refresh_snapshot() is not None
+    
+    def _fresh_snapshot(self):
+        with self._snapshot_lock:
+            if self._snapshot is not None and time.monotonic() - self._snapshot_at < self.snapshot_ttl:
+                self.snapshot_hits += 1
+                return self._snapshot
+            return None
+    
+    def _get_snapshot(self):
+        """Trả về snapshot, chỉ tải lại khi đã quá JSONBIN_SNAPSHOT_TTL giây"""
+        data = self._fresh_snapshot()
+        if data is not None:
+            return data
+        # Đã có snapshot cũ và đang có thread khác tải lại: dùng tạm bản cũ thay vì chờ
+        if not self._refresh_lock.acquire(blocking=self._snapshot is None):
+            return self._snapshot
+        try:
+            data = self._fresh_snapshot()
+            if data is None:
+                data = self._refresh_snapshot()
+        finally:
+            self._refresh_lock.release()
+        if data is None:
+            # Không tải được: dùng tạm snapshot cũ nếu có (None nếu chưa từng tải được)
+            return self._snapshot
+        return data
+    
+    def _refresh_snapshot(self):
+        """Tải bin ngoài lock, chỉ giữ _snapshot_lock lúc thay snapshot mới vào"""
+        with self._snapshot_lock:
+            generation = self._snapshot_generation
+        data, metadata = self._read_record()
+        self.last_refresh_ok = data is not None
+        if data is not None:
+            with self._snapshot_lock:
+                if self._snapshot_generation != generation:
+                    # Có lần ghi xong trong lúc đang tải: snapshot hiện tại mới hơn bản vừa tải
+                    return self._snapshot
+                self.snapshot_refreshes += 1
+                self._snapshot = data
+                self._snapshot_meta = metadata
+                self._snapshot_at = time.monotonic()
+        return data
+    
+    def _set_snapshot(self, data, metadata):
+        """Sau một lần ghi thành công, nội dung bin đã biết trước nên không cần tải lại"""
+        with self._snapshot_lock:
+            self._snapshot_generation += 1
+            self._snapshot = dict(data)
+            self._snapshot_meta = metadata
+            self._snapshot_at = time.monotonic()
+    
+    def _read_record(self):
+        """Tải (bản ghi, metadata) từ JSONBin; bản ghi là None nếu lỗi để không ghi đè nhầm bằng bin rỗng"""
         if not self.bin_id:
             print("⚠️ No bin ID, creating new bin...")
             self.create_bin()
-            return {}
+            return {}, {}
             
         try:
             response = requests.get(
                 f"{self.base_url}/b/{self.bin_id}/latest",
-                headers=self._get_headers()
+                headers=self._get_headers(),
+                timeout=HTTP_TIMEOUT
             )
             
             if response.status_code == 200:
                 data = response.json()
-                return data.get('record', {})
+                return data.get('record', {}), data.get('metadata', {})
             elif response.status_code == 404:
                 print("⚠️ Bin not found, creating new one...")
                 self.create_bin()
-                return {}
+                return {}, {}
             else:
                 print(f"❌ Failed to read from JSONBin: {response.status_code}")
-                return {}
+                return None, None
         except Exception as e:
             print(f"❌ JSONBin read error: {e}")
-            return {}
+            return None, None
+    
+    def snapshot_info(self):
+        """Thông tin snapshot: tuổi, version, số lần phục vụ từ bộ nhớ / tải lại"""
+        with self._snapshot_lock:
+            return {
+                'loaded': self._snapshot is not None,
+                'age_seconds': round(time.monotonic() - self._snapshot_at, 1) if self._snapshot is not None else None,
+                'version': self._snapshot_meta.get('version') if self._snapshot_meta else None,
+                'records': len(self._snapshot) if self._snapshot is not None else 0,
+                'hits': self.snapshot_hits,
+                'refreshes': self.snapshot_refreshes,
+            }
+    
+    def _apply_pending(self, data):
+        with self._pending_lock:
+            for user_id, record in self._pending.items():
+                if record is None:
+                    data.pop(user_id, None)
+                else:
+                    data[user_id] = record
+        return data
     
     def write_data(self, data):
         """Ghi dữ liệu vào JSONBin"""
@@ -128,11 +321,18 @@ class JSONBinStorage:
             response = requests.put(
                 f"{self.base_url}/b/{self.bin_id}",
                 json=data,
-                headers=self._get_headers()
+                headers=self._get_headers(),
+                timeout=HTTP_TIMEOUT
             )
             
             if response.status_code == 200:
                 print("✅ Data saved to JSONBin successfully")
+                # Dữ liệu đã được lưu; metadata (version) chỉ là thông tin thêm nên body lỗi không làm hỏng lần ghi
+                try:
+                    metadata = response.json().get('metadata', {})
+                except (ValueError, AttributeError):
+                    metadata = {}
+                self._set_snapshot(data, metadata)
                 return True
             else:
                 print(f"❌ Failed to save to JSONBin: {response.status_code} - {response.text}")
@@ -151,55 +351,363 @@ class JSONBinStorage:
         return user_data
     
     def save_user_token(self, user_id, access_token, username=None, avatar_hash=None):
-        """Lưu token của user vào JSONBin"""
-        data = self.read_data()
-        
-        data[str(user_id)] = {
+        """Đưa token của user vào hàng đợi ghi JSONBin"""
+        return self._enqueue(str(user_id), {
             'access_token': access_token,
             'username': username,
             'avatar_hash': avatar_hash,
             'updated_at': str(time.time())
-        }
-        
-        return self.write_data(data)
+        })
 
     def delete_user(self, user_id):
-        """Xóa một user khỏi JSONBin"""
-        data = self.read_data()
-        if str(user_id) in data:
-            del data[str(user_id)]
-            return self.write_data(data)
-        return True # Trả về True nếu user không tồn tại sẵn
+        """
+        Xóa một user khỏi JSONBin ngay bằng một lần PUT.
+        Trả về True nếu đã ghi, WRITE_QUEUED nếu PUT lỗi và lệnh xóa được giữ lại để thử lại nền.
+        """
+        with self._pending_lock:
+            self._pending[str(user_id)] = None
+            self.queued_count += 1
+        if self.flush():
+            return True
+        with self._pending_lock:
+            self._schedule_flush(max(self.flush_delay, 5))
+        return WRITE_QUEUED
+
+    def _enqueue(self, user_id, record):
+        """
+        Gom thay đổi; thay đổi sau của cùng một user sẽ ghi đè thay đổi trước.
+        Trả về WRITE_QUEUED vì thay đổi chỉ mới vào hàng đợi, chưa được ghi.
+        """
+        if self._closed:
+            # Đang tắt bot: ghi thẳng thay vì chờ timer
+            with self._pending_lock:
+                self._pending[user_id] = record
+                self.queued_count += 1
+            return self.flush()
+        with self._pending_lock:
+            self._pending[user_id] = record
+            self.queued_count += 1
+            self._schedule_flush(self.flush_delay)
+        return WRITE_QUEUED
+
+    def _schedule_flush(self, delay):
+        """Hẹn một lần flush nếu còn thay đổi chờ và chưa có timer (gọi khi đang giữ _pending_lock)"""
+        if self._pending and self._flush_timer is None and not self._closed:
+            self._flush_timer = threading.Timer(delay, self._flush_from_timer)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush_from_timer(self):
+        with self._pending_lock:
+            self._flush_timer = None
+        if not self.flush():
+            # Giữ lại thay đổi và thử lại sau
+            with self._pending_lock:
+                self._schedule_flush(max(self.flush_delay, 5))
+
+    def flush(self):
+        """Ghi toàn bộ thay đổi đang chờ bằng một lần đọc + một lần PUT"""
+        with self._write_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return True
+            
+            data, _ = self._read_record()
+            success = False
+            if data is not None:
+                for user_id, record in batch.items():
+                    if record is None:
+                        data.pop(user_id, None)
+                    else:
+                        data[user_id] = record
+                success = self.write_data(data)
+            
+            if success:
+                self.flush_count += 1
+                self.flushed_count += len(batch)
+                return True
+            
+            # Trả lại các thay đổi chưa bị thay đổi mới hơn ghi đè
+            self.failed_flush_count += 1
+            with self._pending_lock:
+                for user_id, record in batch.items():
+                    self._pending.setdefault(user_id, record)
+            return False
+
+    def save_many(self, records, progress=None):
+        """Gộp nhiều bản ghi vào hàng đợi rồi ghi ngay bằng một lần PUT"""
+        records = {str(user_id): record for user_id, record in records.items()}
+        with self._pending_lock:
+            previous = {user_id: self._pending[user_id] for user_id in records if user_id in self._pending}
+            self._pending.update(records)
+            self.queued_count += len(records)
+        if not self.flush():
+            # Người gọi được báo lỗi nên bỏ lô này khỏi hàng đợi, chỉ thử lại các thay đổi vốn đã chờ
+            with self._pending_lock:
+                for user_id, record in records.items():
+                    if self._pending.get(user_id) is record:
+                        if user_id in previous:
+                            self._pending[user_id] = previous[user_id]
+                        else:
+                            del self._pending[user_id]
+                self._schedule_flush(max(self.flush_delay, 5))
+            raise RuntimeError("JSONBin write failed, batch was not written")
+        if progress is not None:
+            progress['done'] += len(records)
+        return len(records)
+
+    def pending_count(self):
+        with self._pending_lock:
+            return len(self._pending)
+
+    def stats(self):
+        """Thống kê write-behind: đang chờ, đã ghi, số lần PUT"""
+        return {
+            'pending': self.pending_count(),
+            'queued': self.queued_count,
+            'flushed': self.flushed_count,
+            'flushes': self.flush_count,
+            'failed_flushes': self.failed_flush_count,
+        }
+
+    def close(self):
+        """Hủy timer và ghi nốt các thay đổi còn lại (gọi khi tắt bot)"""
+        with self._pending_lock:
+            self._closed = True
+            timer, self._flush_timer = self._flush_timer, None
+        if timer:
+            timer.cancel()
+        if self.pending_count():
+            print(f"💾 Flushing {self.pending_count()} pending JSONBin changes...")
+            self.flush()
 
 # Khởi tạo JSONBin storage
 jsonbin_storage = JSONBinStorage()
+atexit.register(jsonbin_storage.close)
+
+# --- DATABASE CONNECTION POOL ---
+# Các câu lệnh SQL dùng thường xuyên, được PREPARE một lần cho mỗi connection
+PREPARED_STATEMENTS = {
+    'get_token': "SELECT access_token FROM user_tokens WHERE user_id = $1",
+    'get_tokens': "SELECT user_id, access_token FROM user_tokens WHERE user_id = ANY($1)",
+    'upsert_token': """
+        INSERT INTO user_tokens (user_id, access_token, username, avatar_hash)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (user_id)
+        DO UPDATE SET
+            access_token = EXCLUDED.access_token,
+            username = EXCLUDED.username,
+            avatar_hash = EXCLUDED.avatar_hash,
+            updated_at = CURRENT_TIMESTAMP
+    """,
+    'delete_token': "DELETE FROM user_tokens WHERE user_id = $1",
+    'count_tokens': "SELECT COUNT(*) FROM user_tokens",
+}
+
+class PoolTimeout(Exception):
+    """Không lấy được connection nào trong thời gian chờ cho phép"""
+
+class DatabasePool:
+    """Pool connection PostgreSQL có giới hạn, an toàn giữa các thread (bot + Flask)"""
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT, idle_check=DB_POOL_IDLE_CHECK):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._cond = threading.Condition()
+        self._idle = []          # [(connection, thời điểm trả về pool)]
+        self._prepared = {}      # id(connection) -> tên các statement đã PREPARE
+        self._size = 0
+        self._in_use = 0
+        self._waiters = 0
+        self._checkouts = 0
+        self._checkout_total = 0.0
+        self._checkout_max = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, sslmode='require')
+
+    def _close(self, conn):
+        self._prepared.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, last_used):
+        """Connection vừa dùng thì tin tưởng, rảnh lâu thì ping lại bằng SELECT 1"""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.idle_check:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def warm_up(self):
+        """Mở trước `minconn` connection"""
+        conns = []
+        try:
+            for _ in range(self.minconn):
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+
+    def getconn(self):
+        """Lấy một connection từ pool, chờ tối đa `timeout` giây nếu pool đã đầy"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        conn, last_used, create = None, 0.0, False
+        with self._cond:
+            while not self._idle and self._size >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                self._waiters += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiters -= 1
+            if self._idle:
+                conn, last_used = self._idle.pop()
+            else:
+                self._size += 1
+                create = True
+            self._in_use += 1
+
+        # Kết nối / kiểm tra sức khỏe nằm ngoài lock để không chặn các thread khác
+        try:
+            if create:
+                conn = self._connect()
+            elif not self._is_healthy(conn, last_used):
+                self._close(conn)
+                with self._cond:
+                    self._discarded += 1
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._cond:
+            self._checkouts += 1
+            self._checkout_total += elapsed
+            self._checkout_max = max(self._checkout_max, elapsed)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Trả connection về pool (hoặc đóng hẳn nếu `discard`)"""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        discard = discard or bool(conn.closed)
+        if discard:
+            self._close(conn)
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+                self._discarded += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """with db_pool.connection() as conn: ... — connection lỗi sẽ bị loại khỏi pool"""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except Exception:
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def execute(self, cursor, name, params=()):
+        """Chạy statement `name` trong PREPARED_STATEMENTS, PREPARE một lần cho mỗi connection"""
+        prepared = self._prepared.setdefault(id(cursor.connection), set())
+        if name not in prepared:
+            cursor.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+            prepared.add(name)
+        if params:
+            placeholders = ", ".join(["%s"] * len(params))
+            cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+        else:
+            cursor.execute(f"EXECUTE {name}")
+
+    def stats(self):
+        """Thống kê pool: số connection đang dùng, đang chờ, độ trễ checkout"""
+        with self._cond:
+            return {
+                'size': self._size,
+                'max': self.maxconn,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiters': self._waiters,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'avg_checkout_ms': round(self._checkout_total / self._checkouts * 1000, 2) if self._checkouts else 0.0,
+                'max_checkout_ms': round(self._checkout_max * 1000, 2),
+            }
+
+    def closeall(self):
+        """Đóng toàn bộ connection đang rảnh (gọi khi tắt bot)"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+db_pool = DatabasePool(DATABASE_URL) if DATABASE_URL and HAS_PSYCOPG2 else None
 
 # --- DATABASE SETUP ---
 def init_database():
     """Khởi tạo database và tạo bảng nếu chưa có"""
-    if not DATABASE_URL or not HAS_PSYCOPG2:
+    if not db_pool:
         print("⚠️ WARNING: Không có DATABASE_URL hoặc psycopg2, sử dụng JSONBin.io")
         return False
     
     try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        cursor = conn.cursor()
-        
-        # Tạo bảng user_tokens nếu chưa có
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_tokens (
-                user_id VARCHAR(50) PRIMARY KEY,
-                access_token TEXT NOT NULL,
-                username VARCHAR(100),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print("✅ Database initialized successfully")
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Tạo bảng user_tokens nếu chưa có
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_tokens (
+                    user_id VARCHAR(50) PRIMARY KEY,
+                    access_token TEXT NOT NULL,
+                    username VARCHAR(100),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # Bảng cũ được tạo trước khi có cột avatar_hash
+            cursor.execute("ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS avatar_hash VARCHAR(100)")
+            
+            conn.commit()
+            cursor.close()
+        db_pool.warm_up()
+        print(f"✅ Database initialized successfully (pool max {db_pool.maxconn} connections)")
         return True
         
     except Exception as e:
@@ -207,199 +715,2188 @@ def init_database():
         print("🔄 Falling back to JSONBin.io storage")
         return False
 
-# --- DATABASE FUNCTIONS ---
-def get_db_connection():
-    """Tạo connection tới database"""
-    if DATABASE_URL and HAS_PSYCOPG2:
+# --- DATABASE FUNCTIONS ---
+def get_user_access_token_db(user_id: str):
+    """Lấy access token từ database. Lỗi được ném ra để phân biệt với 'không có token'"""
+    if not db_pool:
+        return None
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        db_pool.execute(cursor, 'get_token', (user_id,))
+        result = cursor.fetchone()
+        cursor.close()
+        return result[0] if result else None
+
+def get_user_access_tokens_db(user_ids: list):
+    """Lấy access token của nhiều user bằng một truy vấn. Lỗi được ném ra để phân biệt với 'không có token'"""
+    if not db_pool or not user_ids:
+        return {}
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        db_pool.execute(cursor, 'get_tokens', (list(user_ids),))
+        result = dict(cursor.fetchall())
+        cursor.close()
+        return result
+
+def save_user_token_db(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
+    """Lưu access token vào database"""
+    if not db_pool:
+        return False
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            db_pool.execute(cursor, 'upsert_token', (user_id, access_token, username, avatar_hash))
+            conn.commit()
+            cursor.close()
+        print(f"✅ Saved token for user {user_id} to database")
+        return True
+    except Exception as e:
+        print(f"Database error: {e}")
+    return False
+
+def count_tokens_db():
+    """Đếm số token trong database (None nếu lỗi)"""
+    if not db_pool:
+        return None
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            db_pool.execute(cursor, 'count_tokens')
+            count = cursor.fetchone()[0]
+            cursor.close()
+            return count
+    except Exception as e:
+        print(f"Database error: {e}")
+    return None
+
+def load_tokens_db():
+    """Đọc toàn bộ token trong database (ném lỗi ra ngoài để người gọi báo cáo)"""
+    tokens = {}
+    if not db_pool:
+        return tokens
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, access_token, username, avatar_hash, EXTRACT(EPOCH FROM updated_at) FROM user_tokens")
+        for row in cursor.fetchall():
+            tokens[row[0]] = {
+                'access_token': row[1],
+                'username': row[2],
+                'avatar_hash': row[3],
+                'updated_at': str(float(row[4])) if row[4] is not None else str(time.time())
+            }
+        cursor.close()
+    return tokens
+
+def save_tokens_db_bulk(records: dict, progress: dict = None, batch_size: int = DB_BULK_BATCH_SIZE):
+    """Upsert nhiều token trong một transaction duy nhất (INSERT nhiều dòng theo từng lô)"""
+    if not db_pool:
+        raise RuntimeError("Database not configured")
+    rows = [
+        (user_id, record['access_token'], record.get('username'), record.get('avatar_hash'))
+        for user_id, record in records.items()
+    ]
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO user_tokens (user_id, access_token, username, avatar_hash)
+                VALUES %s
+                ON CONFLICT (user_id)
+                DO UPDATE SET
+                    access_token = EXCLUDED.access_token,
+                    username = EXCLUDED.username,
+                    avatar_hash = EXCLUDED.avatar_hash,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', batch, page_size=batch_size)
+            if progress is not None:
+                progress['done'] += len(batch)
+        conn.commit()
+        cursor.close()
+    print(f"✅ Bulk saved {len(rows)} tokens to database")
+    return len(rows)
+
+# --- LOCAL TOKEN STORE ---
+class LocalTokenStore:
+    """Kho token cục bộ bằng SQLite (WAL): ghi O(1), an toàn khi thread bot và Flask cùng ghi"""
+    def __init__(self, path=LOCAL_TOKEN_DB, legacy_json=LEGACY_TOKENS_JSON):
+        self.path = path
+        self.legacy_json = legacy_json
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        """Mở database lần đầu dùng (gọi khi đang giữ lock)"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_tokens (
+                    user_id TEXT PRIMARY KEY,
+                    access_token TEXT NOT NULL,
+                    username TEXT,
+                    avatar_hash TEXT,
+                    updated_at TEXT
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn = conn
+            self._import_legacy_json()
+        return self._conn
+
+    def _import_legacy_json(self):
+        """Nhập tokens.json cũ một lần duy nhất khi khởi động lần đầu"""
+        conn = self._conn
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_json_imported'").fetchone():
+            return
+        imported = 0
+        try:
+            with open(self.legacy_json, 'r') as f:
+                tokens = json.load(f)
+        except FileNotFoundError:
+            tokens = {}
+        except json.JSONDecodeError as e:
+            print(f"⚠️ Could not import {self.legacy_json}: {e}")
+            tokens = {}
+        with conn:
+            conn.execute("BEGIN")
+            for user_id, token_data in tokens.items():
+                if isinstance(token_data, dict):
+                    access_token = token_data.get('access_token')
+                    row = (str(user_id), access_token, token_data.get('username'), token_data.get('avatar_hash'), token_data.get('updated_at') or str(time.time()))
+                else:
+                    access_token = token_data
+                    row = (str(user_id), access_token, None, None, str(time.time()))
+                if access_token:
+                    conn.execute("INSERT OR IGNORE INTO user_tokens VALUES (?, ?, ?, ?, ?)", row)
+                    imported += 1
+            conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_json_imported', ?)", (str(time.time()),))
+        if imported:
+            print(f"✅ Imported {imported} tokens from {self.legacy_json} into {self.path}")
+
+    @staticmethod
+    def _row_to_record(row):
+        return {'access_token': row[1], 'username': row[2], 'avatar_hash': row[3], 'updated_at': row[4]}
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._db().execute("SELECT * FROM user_tokens WHERE user_id = ?", (str(user_id),)).fetchone()
+        return self._row_to_record(row) if row else None
+
+    def get_many(self, user_ids):
+        user_ids = [str(uid) for uid in user_ids]
+        if not user_ids:
+            return {}
+        placeholders = ", ".join("?" * len(user_ids))
+        with self._lock:
+            rows = self._db().execute(f"SELECT * FROM user_tokens WHERE user_id IN ({placeholders})", user_ids).fetchall()
+        return {row[0]: self._row_to_record(row) for row in rows}
+
+    def load_all(self):
+        with self._lock:
+            rows = self._db().execute("SELECT * FROM user_tokens").fetchall()
+        return {row[0]: self._row_to_record(row) for row in rows}
+
+    def save_many(self, records):
+        """Upsert nhiều bản ghi trong một transaction"""
+        rows = [
+            (str(user_id), record['access_token'], record.get('username'), record.get('avatar_hash'), record.get('updated_at') or str(time.time()))
+            for user_id, record in records.items()
+        ]
+        with self._lock:
+            conn = self._db()
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT OR REPLACE INTO user_tokens VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def delete(self, user_id):
+        with self._lock:
+            conn = self._db()
+            with conn:
+                conn.execute("DELETE FROM user_tokens WHERE user_id = ?", (str(user_id),))
+
+    def count(self):
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM user_tokens").fetchone()[0]
+
+    def close(self):
+        """Gộp WAL vào file chính rồi đóng (gọi khi tắt bot)"""
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                finally:
+                    self._conn.close()
+                    self._conn = None
+
+local_store = LocalTokenStore()
+atexit.register(local_store.close)
+
+def load_tokens_local():
+    """Đọc toàn bộ token trong local store"""
+    return local_store.load_all()
+
+def save_tokens_local_bulk(records: dict, progress: dict = None):
+    """Gộp nhiều token vào local store trong một transaction"""
+    count = local_store.save_many(records)
+    if progress is not None:
+        progress['done'] += count
+    print(f"✅ Bulk saved {count} tokens to local store")
+    return count
+
+def save_user_token_local(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
+    """Backup: Lưu token vào local store"""
+    try:
+        local_store.save_many({user_id: {
+            'access_token': access_token,
+            'username': username,
+            'avatar_hash': avatar_hash,
+            'updated_at': str(time.time())
+        }})
+        print(f"✅ Saved token for user {user_id} to local store")
+        return True
+    except Exception as e:
+        print(f"Local store error: {e}")
+        return False
+
+# --- TOKEN CACHE ---
+CACHE_MISS = object()
+
+def extract_access_token(user_data):
+    """Bản ghi lưu trữ có thể là dict hoặc chỉ là token (định dạng cũ)"""
+    if isinstance(user_data, dict):
+        return user_data.get('access_token')
+    return user_data
+
+class TokenCache:
+    """Cache LRU có TTL cho access token, dùng chung giữa thread bot và Flask"""
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL, negative_ttl=TOKEN_CACHE_NEGATIVE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()   # user_id -> (token hoặc None, thời điểm hết hạn)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Trả về token (None = đã biết là chưa ủy quyền) hoặc CACHE_MISS"""
+        key = str(user_id)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return CACHE_MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, user_id, token):
+        """Ghi token vào cache (token rỗng được nhớ như kết quả âm với TTL ngắn hơn)"""
+        ttl = self.ttl if token else self.negative_ttl
+        with self._lock:
+            self._store(str(user_id), token or None, ttl)
+
+    def set_many(self, tokens):
+        """Nạp nhiều token một lúc, ví dụ sau khi đã tải cả bin JSONBin"""
+        with self._lock:
+            for user_id, token in tokens.items():
+                if token:
+                    self._store(str(user_id), token, self.ttl)
+
+    def _store(self, key, token, ttl):
+        self._data[key] = (token, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total * 100, 1) if total else 0.0,
+            }
+
+token_cache = TokenCache()
+
+# --- PARALLEL TIER WRITES ---
+# Tầng được coi là đã lưu bền vững ngay khi ghi xong (JSONBin chỉ mới vào hàng đợi write-behind)
+DURABLE_TIERS = ('db', 'local')
+
+class TierWriteStats:
+    """Độ trễ và số lần lỗi / thử lại / quá thời gian của từng tầng lưu trữ"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tiers = {}
+
+    def _tier(self, tier):
+        return self._tiers.setdefault(tier, {'writes': 0, 'failures': 0, 'retries': 0, 'timeouts': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+
+    def record(self, tier, elapsed, success, retry=False):
+        with self._lock:
+            stats = self._tier(tier)
+            stats['writes'] += 1
+            stats['failures'] += 0 if success else 1
+            stats['retries'] += 1 if retry else 0
+            stats['total_ms'] += elapsed * 1000
+            stats['max_ms'] = max(stats['max_ms'], elapsed * 1000)
+
+    def record_timeout(self, tier):
+        with self._lock:
+            self._tier(tier)['timeouts'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                tier: {
+                    'writes': stats['writes'],
+                    'failures': stats['failures'],
+                    'retries': stats['retries'],
+                    'timeouts': stats['timeouts'],
+                    'avg_ms': round(stats['total_ms'] / stats['writes'], 1) if stats['writes'] else 0.0,
+                    'max_ms': round(stats['max_ms'], 1),
+                }
+                for tier, stats in self._tiers.items()
+            }
+
+tier_write_stats = TierWriteStats()
+tier_write_executor = ThreadPoolExecutor(max_workers=6, thread_name_prefix='tier-write')
+
+class UserWriteSequencer:
+    """
+    Thứ tự ghi theo user: mỗi lần lưu / xóa nhận một thế hệ mới và lần thử lại của thế hệ cũ bị bỏ.
+    Mỗi (user, tầng) có lock riêng để lần ghi cũ đang chạy không thể đè lên lần ghi mới hơn.
+    Bản ghi của một user bị dọn khi lần ghi cuối cùng của user đó xong.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generations = {}   # user_id -> thế hệ mới nhất
+        self._writers = {}       # user_id -> số lần ghi / xóa chưa xong
+        self._tier_locks = {}    # (user_id, tier) -> [Lock, số thread đang giữ hoặc chờ]
+
+    def begin(self, user_id):
+        """Bắt đầu thế hệ mới, người gọi được tính là một writer và phải release() khi xong"""
+        key = str(user_id)
+        with self._lock:
+            generation = self._generations.get(key, 0) + 1
+            self._generations[key] = generation
+            self._writers[key] = self._writers.get(key, 0) + 1
+            return generation
+
+    def retain(self, user_id):
+        """Thêm một writer (ví dụ một tầng ghi chạy nền) cho thế hệ hiện tại"""
+        key = str(user_id)
+        with self._lock:
+            self._writers[key] = self._writers.get(key, 0) + 1
+
+    def release(self, user_id):
+        key = str(user_id)
+        with self._lock:
+            self._writers[key] -= 1
+            if not self._writers[key]:
+                del self._writers[key]
+                self._generations.pop(key, None)
+
+    def is_current(self, user_id, generation):
+        with self._lock:
+            return self._generations.get(str(user_id)) == generation
+
+    @contextmanager
+    def tier_lock(self, user_id, tier):
+        key = (str(user_id), tier)
+        with self._lock:
+            entry = self._tier_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._tier_locks[key]
+
+user_write_sequencer = UserWriteSequencer()
+
+def write_tier_with_retry(tier, func, args, user_id=None, generation=None, result=None, attempt=0):
+    """
+    Một lần ghi vào một tầng; nếu thất bại thì hẹn lần thử lại bằng timer (backoff lũy thừa) thay vì ngủ trong worker.
+    Kết quả cuối cùng được đặt vào Future `result`. Lần ghi đã bị lần ghi / xóa mới hơn thay thế được tính là xong.
+    """
+    if result is None:
+        result = concurrent.futures.Future()
+    with user_write_sequencer.tier_lock(user_id, tier):
+        if generation is not None and not user_write_sequencer.is_current(user_id, generation):
+            print(f"⏭️ {tier} write for {user_id} superseded by a newer write/delete")
+            return _finish_tier_write(result, True, user_id, generation)
+        start = time.monotonic()
+        try:
+            success = func(*args)
+        except Exception as e:
+            print(f"❌ {tier} write error: {e}")
+            success = False
+        tier_write_stats.record(tier, time.monotonic() - start, success, retry=attempt > 0)
+    if success:
+        return _finish_tier_write(result, success, user_id, generation)
+    if attempt < TIER_WRITE_RETRIES - 1:
+        timer = threading.Timer(min(2 ** attempt, 10), _retry_tier_write,
+                                (tier, func, args, user_id, generation, result, attempt + 1))
+        timer.daemon = True
+        timer.start()
+        return result
+    print(f"❌ {tier} write failed after {TIER_WRITE_RETRIES} attempts")
+    return _finish_tier_write(result, False, user_id, generation)
+
+def _retry_tier_write(tier, func, args, user_id, generation, result, attempt):
+    try:
+        tier_write_executor.submit(write_tier_with_retry, tier, func, args, user_id, generation, result, attempt)
+    except RuntimeError:
+        # Executor đã tắt (bot đang dừng)
+        _finish_tier_write(result, False, user_id, generation)
+
+def _finish_tier_write(result, value, user_id, generation):
+    if generation is not None:
+        user_write_sequencer.release(user_id)
+    result.set_result(value)
+    return result
+
+def fan_out_write(writers: dict, user_id=None, generation=None):
+    """
+    Chạy song song các hàm ghi {tier: (func, args)}.
+    Trả về ngay khi một tầng bền vững xác nhận; các tầng còn lại tiếp tục chạy nền (kèm thử lại).
+    """
+    start = time.monotonic()
+    futures = {}
+    for tier, (func, args) in writers.items():
+        if generation is not None:
+            user_write_sequencer.retain(user_id)
+        result = concurrent.futures.Future()
+        tier_write_executor.submit(write_tier_with_retry, tier, func, args, user_id, generation, result)
+        futures[result] = tier
+    deadlines = {future: start + TIER_WRITE_TIMEOUTS.get(tier, 10) for future, tier in futures.items()}
+    pending = set(futures)
+    acknowledged = []
+    
+    while pending:
+        timeout = max(0.0, min(deadlines[future] for future in pending) - time.monotonic())
+        done, pending = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        # WRITE_QUEUED chỉ là đã vào hàng đợi write-behind, chưa tính là tầng đã xác nhận ghi
+        acknowledged += [futures[future] for future in done if future.result() is True]
+        if any(tier in DURABLE_TIERS for tier in acknowledged):
+            break
+        # Tầng quá thời gian vẫn chạy tiếp ở nền, chỉ là không chờ nữa
+        now = time.monotonic()
+        for future in [f for f in pending if deadlines[f] <= now]:
+            tier_write_stats.record_timeout(futures[future])
+            pending.discard(future)
+    return acknowledged
+
+# --- UNIFIED TOKEN FUNCTIONS ---
+def get_user_access_token(user_id: int):
+    """Lấy access token (Ưu tiên: Cache > Database > JSONBin.io > Local store)"""
+    user_id_str = str(user_id)
+    
+    cached = token_cache.get(user_id_str)
+    if cached is not CACHE_MISS:
+        return cached
+    
+    token, complete = lookup_user_access_token(user_id_str)
+    # Chỉ nhớ kết quả âm khi mọi tầng đều trả lời; tầng lỗi tạm thời không được biến thành "chưa ủy quyền"
+    if token or complete:
+        token_cache.set(user_id_str, token)
+    return token
+
+def get_user_access_tokens(user_ids):
+    """Lấy access token cho nhiều user: cache → 1 truy vấn DB → 1 lần đọc JSONBin → Local store"""
+    tokens = {}
+    missing = []
+    for user_id in dict.fromkeys(str(uid) for uid in user_ids):
+        cached = token_cache.get(user_id)
+        if cached is CACHE_MISS:
+            missing.append(user_id)
+        else:
+            tokens[user_id] = cached
+    if not missing:
+        return tokens
+    
+    complete = True
+    try:
+        found = {uid: token for uid, token in get_user_access_tokens_db(missing).items() if token}
+    except Exception as e:
+        print(f"Database error: {e}")
+        found = {}
+        complete = False
+    remaining = [uid for uid in missing if uid not in found]
+    
+    if remaining and JSONBIN_API_KEY:
+        try:
+            data = jsonbin_storage.read_data(strict=True)
+        except StorageUnavailable as e:
+            print(f"JSONBin error: {e}")
+            data = {}
+            complete = False
+        for uid in remaining:
+            token = extract_access_token(data.get(uid))
+            if token:
+                found[uid] = token
+        remaining = [uid for uid in remaining if uid not in found]
+    
+    if remaining:
+        try:
+            local_tokens = local_store.get_many(remaining)
+        except sqlite3.Error as e:
+            print(f"Local store error: {e}")
+            local_tokens = {}
+            complete = False
+        for uid in remaining:
+            token = extract_access_token(local_tokens.get(uid))
+            if token:
+                found[uid] = token
+    
+    for uid in missing:
+        # Chỉ nhớ kết quả âm khi mọi tầng đều trả lời
+        if found.get(uid) or complete:
+            token_cache.set(uid, found.get(uid))
+        tokens[uid] = found.get(uid)
+    return tokens
+
+def lookup_user_access_token(user_id_str: str):
+    """Tra token qua các tầng lưu trữ, bỏ qua cache. Trả về (token, complete); complete=False nếu có tầng bị lỗi"""
+    complete = True
+    
+    # Try database first
+    try:
+        token = get_user_access_token_db(user_id_str)
+        if token:
+            return token, True
+    except Exception as e:
+        print(f"Database error: {e}")
+        complete = False
+    
+    # Try JSONBin.io
+    if JSONBIN_API_KEY:
+        try:
+            data = jsonbin_storage.read_data(strict=True)
+            if not db_pool:
+                # Không có database ưu tiên hơn, nên cả bin vừa tải về đều là giá trị đúng để cache
+                token_cache.set_many({uid: extract_access_token(user_data) for uid, user_data in data.items()})
+            token = extract_access_token(data.get(user_id_str))
+            if token:
+                return token, True
+        except StorageUnavailable as e:
+            print(f"JSONBin error: {e}")
+            complete = False
+    
+    # Fallback to local store (for local development)
+    try:
+        return extract_access_token(local_store.get(user_id_str)), complete
+    except sqlite3.Error as e:
+        print(f"Local store error: {e}")
+        return None, False
+
+def save_user_token(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
+    """Lưu access token (Database + JSONBin.io + Local backup), ghi song song các tầng"""
+    args = (user_id, access_token, username, avatar_hash)
+    writers = {'local': (save_user_token_local, args)}
+    if db_pool:
+        writers['db'] = (save_user_token_db, args)
+    if JSONBIN_API_KEY:
+        writers['jsonbin'] = (jsonbin_storage.save_user_token, args)
+    
+    generation = user_write_sequencer.begin(user_id)
+    try:
+        success = bool(fan_out_write(writers, user_id, generation))
+        if success and user_write_sequencer.is_current(user_id, generation):
+            token_cache.set(user_id, access_token)
+        else:
+            token_cache.invalidate(user_id)
+    finally:
+        user_write_sequencer.release(user_id)
+    return success
+
+def delete_user_from_db(user_id: str):
+    """Xóa user khỏi database"""
+    if not db_pool:
+        return False
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            db_pool.execute(cursor, 'delete_token', (user_id,))
+            conn.commit()
+            cursor.close()
+        print(f"✅ Deleted user {user_id} from database")
+        return True
+    except Exception as e:
+        print(f"Database delete error: {e}")
+    return False
+
+def delete_user_from_local(user_id: str):
+    """Xóa user khỏi local store"""
+    try:
+        local_store.delete(user_id)
+        print(f"✅ Deleted user {user_id} from local store")
+        return True
+    except Exception as e:
+        print(f"Local store delete error: {e}")
+        return False
+
+def delete_user_token(user_id: str):
+    """Xóa user khỏi mọi storage, trả về kết quả (database, JSONBin.io, local store)"""
+    user_id_str = str(user_id)
+    # Thế hệ mới khiến các lần ghi / thử lại đang chờ của user này tự hủy, tier lock chờ lần ghi đang chạy xong
+    user_write_sequencer.begin(user_id_str)
+    try:
+        with user_write_sequencer.tier_lock(user_id_str, 'db'):
+            db_success = delete_user_from_db(user_id_str)
+        with user_write_sequencer.tier_lock(user_id_str, 'jsonbin'):
+            jsonbin_success = jsonbin_storage.delete_user(user_id_str)
+        with user_write_sequencer.tier_lock(user_id_str, 'local'):
+            local_success = delete_user_from_local(user_id_str)
+    finally:
+        user_write_sequencer.release(user_id_str)
+    token_cache.invalidate(user_id_str)
+    return db_success, jsonbin_success, local_success
+
+# --- BULK MIGRATION ---
+MIGRATION_TIERS = ('db', 'jsonbin', 'local')
+MIGRATION_TIER_ALIASES = {'json': 'local'}   # Tên cũ khi local store còn là tokens.json
+
+def normalize_token_record(token_data):
+    """Chuẩn hóa bản ghi token về dạng dict (None nếu không có token)"""
+    if isinstance(token_data, dict):
+        access_token = token_data.get('access_token')
+        record = {
+            'access_token': access_token,
+            'username': token_data.get('username'),
+            'avatar_hash': token_data.get('avatar_hash'),
+            'updated_at': token_data.get('updated_at') or str(time.time())
+        }
+    else:
+        access_token = token_data
+        record = {'access_token': access_token, 'username': None, 'avatar_hash': None, 'updated_at': str(time.time())}
+    return record if access_token else None
+
+def load_tokens(tier: str):
+    """Đọc toàn bộ token của một tầng lưu trữ"""
+    if tier == 'db':
+        return load_tokens_db()
+    if tier == 'jsonbin':
+        return jsonbin_storage.read_data()
+    return load_tokens_local()
+
+def diff_token_records(source: dict, target: dict):
+    """So sánh nguồn với đích: user mới, user thay đổi, user giữ nguyên"""
+    added, changed, unchanged = [], [], []
+    for user_id, record in source.items():
+        existing = normalize_token_record(target.get(user_id))
+        if existing is None:
+            added.append(user_id)
+        elif any(existing.get(key) != record.get(key) for key in ('access_token', 'username', 'avatar_hash')):
+            changed.append(user_id)
+        else:
+            unchanged.append(user_id)
+    return added, changed, unchanged
+
+def write_tokens_bulk(tier: str, records: dict, progress: dict = None):
+    """Ghi nhiều token vào một tầng: 1 transaction (db), 1 PUT (jsonbin), 1 transaction SQLite (local)"""
+    if tier == 'db':
+        return save_tokens_db_bulk(records, progress)
+    if tier == 'jsonbin':
+        return jsonbin_storage.save_many(records, progress)
+    return save_tokens_local_bulk(records, progress)
+
+# --- ASYNC STORAGE FACADE ---
+class AsyncStorage:
+    """Chạy các hàm lưu trữ blocking trên thread pool riêng để không chặn event loop của bot"""
+    def __init__(self, max_workers=STORAGE_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='storage')
+
+    async def run(self, func, *args, **kwargs):
+        """Chạy một hàm blocking bất kỳ trên thread pool lưu trữ"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def get(self, user_id):
+        """Lấy access token (Database > JSONBin.io > Local store)"""
+        return await self.run(get_user_access_token, user_id)
+
+    async def get_many(self, user_ids):
+        """Lấy access token cho nhiều user, trả về {user_id (str): token hoặc None}"""
+        return await self.run(get_user_access_tokens, list(user_ids))
+
+    async def save(self, user_id, access_token, username=None, avatar_hash=None):
+        """Lưu access token vào mọi storage"""
+        return await self.run(save_user_token, str(user_id), access_token, username, avatar_hash)
+
+    async def delete(self, user_id):
+        """Xóa user khỏi mọi storage"""
+        return await self.run(delete_user_token, user_id)
+
+    async def list(self):
+        """Danh sách toàn bộ điệp viên đã lưu (bản ghi JSONBin)"""
+        return await self.run(jsonbin_storage.read_data)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+storage = AsyncStorage()
+
+# --- STORAGE HEALTH PROBER ---
+class StorageHealthProber:
+    """Kiểm tra từng tầng lưu trữ trên thread nền theo chu kỳ; các endpoint chỉ đọc kết quả đã cache"""
+    def __init__(self, interval=HEALTH_CHECK_INTERVAL):
+        self.interval = interval
+        self._results = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _probe_db(self):
+        if not db_pool:
+            return False, "Not configured"
+        # Truy vấn đếm vừa kiểm tra kết nối vừa cho !storage_info số token mà không phải truy vấn lại
+        count = count_tokens_db()
+        return (True, f"Connected ({count} tokens)") if count is not None else (False, "Unavailable")
+
+    def _probe_jsonbin(self):
+        if not JSONBIN_API_KEY:
+            return False, "Not configured"
+        # Chỉ tải lại khi snapshot đã cũ, nên chu kỳ kiểm tra không làm tăng lưu lượng JSONBin
+        data = jsonbin_storage.read_data()
+        if jsonbin_storage.last_refresh_ok is False:
+            return False, "Read failed (serving stale snapshot)"
+        return True, f"Connected ({len(data)} tokens)"
+
+    def _probe_local(self):
+        return True, f"{local_store.count()} tokens"
+
+    def probe_all(self):
+        for tier, probe in (('db', self._probe_db), ('jsonbin', self._probe_jsonbin), ('local', self._probe_local)):
+            start = time.monotonic()
+            try:
+                ok, detail = probe()
+            except Exception as e:
+                ok, detail = False, f"Error: {e}"
+            result = {
+                'ok': ok,
+                'detail': detail,
+                'latency_ms': round((time.monotonic() - start) * 1000, 1),
+                'checked_at': time.time(),
+            }
+            with self._lock:
+                self._results[tier] = result
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='storage-health', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_ok(self, tier):
+        with self._lock:
+            result = self._results.get(tier)
+        return bool(result and result['ok'])
+
+    def is_fresh(self):
+        """Đã có kết quả cho mọi tầng và không cũ quá 2 chu kỳ kiểm tra"""
+        with self._lock:
+            results = list(self._results.values())
+        return len(results) == 3 and all(time.time() - result['checked_at'] < 2 * self.interval for result in results)
+
+    def results(self):
+        """Kết quả kiểm tra gần nhất, kèm số giây kể từ lần kiểm tra"""
+        with self._lock:
+            results = {tier: dict(result) for tier, result in self._results.items()}
+        for result in results.values():
+            result['age_seconds'] = round(time.time() - result['checked_at'], 1)
+        return results
+
+    def describe(self, tier):
+        """Chuỗi trạng thái ngắn cho embed / trang web"""
+        with self._lock:
+            result = self._results.get(tier)
+        if not result:
+            return "⏳ Checking..."
+        age = int(time.time() - result['checked_at'])
+        return f"{'✅' if result['ok'] else '❌'} {result['detail']} ({age}s ago)"
+
+storage_health = StorageHealthProber()
+        
+# --- DISCORD BOT SETUP ---
+intents = discord.Intents.default()
+intents.members = True
+intents.message_content = True
+
+class AgentBot(commands.Bot):
+    async def close(self):
+        """Đóng HTTP session dùng chung trước khi ngắt kết nối gateway"""
+        await http_client.close()
+        await super().close()
+
+bot = AgentBot(command_prefix='!', intents=intents, owner_id=1311892636650438717, help_command=None)
+
+# --- FLASK WEB SERVER SETUP ---
+app = Flask(__name__)
+
+# --- SHARED HTTP CLIENT ---
+class SharedHTTPClient:
+    """Một aiohttp.ClientSession sống suốt vòng đời bot: giữ kết nối keep-alive, cache DNS, tái dùng TLS"""
+    def __init__(self):
+        self._session = None
+
+    def session(self):
+        """Tạo session lần đầu gọi (phải nằm trong event loop của bot)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+http_client = SharedHTTPClient()
+
+# --- DISCORD RATE LIMITER ---
+class RateLimitBucket:
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_after = 1.0
+        self.reset_at = 0.0
+
+class DiscordRateLimiter:
+    """Theo dõi bucket rate limit (X-RateLimit-*) theo route + guild và giới hạn toàn cục của Discord"""
+    def __init__(self, global_rate=DISCORD_GLOBAL_RATE_LIMIT):
+        self.global_rate = global_rate
+        self._route_buckets = {}   # route -> bucket hash Discord trả về
+        self._buckets = {}         # (bucket hash hoặc route, major id) -> RateLimitBucket
+        self._global_reset_at = 0.0
+        self._window_start = 0.0
+        self._window_count = 0
+        self.waits = 0
+        self.rate_limited = 0
+
+    def _key(self, route, major_id):
+        return (self._route_buckets.get(route, route), major_id)
+
+    async def _wait_global(self):
+        while True:
+            now = time.monotonic()
+            if self._global_reset_at > now:
+                self.waits += 1
+                await asyncio.sleep(self._global_reset_at - now)
+                continue
+            if now - self._window_start >= 1:
+                self._window_start, self._window_count = now, 0
+            if self._window_count < self.global_rate:
+                self._window_count += 1
+                return
+            self.waits += 1
+            await asyncio.sleep(self._window_start + 1 - now)
+
+    async def acquire(self, route, major_id):
+        """Chờ tới khi được phép gửi request cho route này"""
+        while True:
+            await self._wait_global()
+            key = self._key(route, major_id)
+            bucket = self._buckets.get(key)
+            now = time.monotonic()
+            if bucket is None:
+                # Chưa biết giới hạn của route: cho một request đi trước, các request khác chờ header của nó
+                # (hoặc tối đa reset_after giây nếu response không có header rate limit)
+                bucket = self._buckets[key] = RateLimitBucket()
+                bucket.limit = 1
+                bucket.remaining = 0
+                bucket.reset_at = now + bucket.reset_after
+                return
+            if bucket.remaining is None:
+                return
+            if bucket.reset_at <= now:
+                # Cửa sổ cũ đã hết: ước lượng cửa sổ mới cho tới khi response tiếp theo cập nhật lại
+                bucket.remaining = bucket.limit
+                bucket.reset_at = now + bucket.reset_after
+            if bucket.remaining is None or bucket.remaining > 0:
+                if bucket.remaining is not None:
+                    bucket.remaining -= 1
+                return
+            self.waits += 1
+            await asyncio.sleep(bucket.reset_at - now)
+
+    def update(self, route, major_id, headers, status, body=None):
+        """Cập nhật bucket từ response; trả về số giây cần chờ nếu bị 429"""
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        if bucket_hash:
+            self._route_buckets[route] = bucket_hash
+        key = self._key(route, major_id)
+        now = time.monotonic()
+        if 'X-RateLimit-Remaining' in headers:
+            bucket = self._buckets.setdefault(key, RateLimitBucket())
+            bucket.limit = int(headers.get('X-RateLimit-Limit', 1))
+            bucket.remaining = int(headers['X-RateLimit-Remaining'])
+            bucket.reset_after = float(headers.get('X-RateLimit-Reset-After', 1))
+            bucket.reset_at = now + bucket.reset_after
+        if status != 429:
+            return 0.0
+        
+        self.rate_limited += 1
+        body = body if isinstance(body, dict) else {}
+        retry_after = float(body.get('retry_after') or headers.get('Retry-After') or 1)
+        if body.get('global') or headers.get('X-RateLimit-Global'):
+            self._global_reset_at = now + retry_after
+        else:
+            bucket = self._buckets.setdefault(key, RateLimitBucket())
+            bucket.limit = bucket.limit or 1
+            bucket.remaining = 0
+            bucket.reset_at = now + retry_after
+        return retry_after
+
+rate_limiter = DiscordRateLimiter()
+
+# --- UTILITY FUNCTIONS ---
+# Mã lỗi JSON của Discord khiến mọi lần thêm vào server đó đều thất bại
+GUILD_ERROR_CODES = {
+    10004,   # Unknown Guild (bot đã rời / bị kick)
+    50001,   # Missing Access
+    50013,   # Missing Permissions (thiếu CREATE_INSTANT_INVITE)
+}
+
+MEMBER_ADD_CATEGORIES = {
+    'ok': "✅ Thành công",
+    'no_token': "🔑 Thiếu token",
+    'rate_limited': "⏳ Rate limit",
+    'transient': "🔁 Lỗi tạm thời",
+    'guild_error': "🚫 Lỗi server (quyền / bot bị kick)",
+    'user_error': "👤 Lỗi người dùng (token / giới hạn server)",
+    'circuit_open': "⛔ Bỏ qua (server lỗi liên tục)",
+}
+
+def classify_member_add_response(status, body=None):
+    """Phân loại phản hồi PUT member: ok / rate_limited / transient (thử lại) hoặc guild_error / user_error (vĩnh viễn)"""
+    if status in (201, 204):
+        return 'ok'
+    if status == 429:
+        return 'rate_limited'
+    if status >= 500 or status in (408, 425):
+        return 'transient'
+    code = body.get('code') if isinstance(body, dict) else None
+    if code in GUILD_ERROR_CODES or (status == 404 and code is None):
+        return 'guild_error'
+    return 'user_error'
+
+def backoff_delay(attempt, base=MEMBER_ADD_BACKOFF_BASE, cap=MEMBER_ADD_BACKOFF_MAX):
+    """Exponential backoff có jitter: ngẫu nhiên trong [d/2, d] với d = base * 2^(attempt-1)"""
+    delay = min(cap, base * (2 ** (attempt - 1)))
+    return random.uniform(delay / 2, delay)
+
+class GuildCircuitBreaker:
+    """Ngắt các lần thêm vào một server sau nhiều lỗi cấp server liên tiếp, cho thử lại một lần sau cooldown"""
+    def __init__(self, threshold=GUILD_BREAKER_THRESHOLD, cooldown=GUILD_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = {}     # guild_id -> số lỗi liên tiếp
+        self._open_until = {}   # guild_id -> thời điểm (monotonic) hết ngắt
+        self._probing = set()   # server đang được thử lại sau cooldown
+        self.trips = 0
+
+    def allow(self, guild_id):
+        open_until = self._open_until.get(guild_id)
+        if open_until is None:
+            return True
+        if time.monotonic() < open_until or guild_id in self._probing:
+            return False
+        self._probing.add(guild_id)
+        return True
+
+    def record_success(self, guild_id):
+        self._failures.pop(guild_id, None)
+        self._open_until.pop(guild_id, None)
+        self._probing.discard(guild_id)
+
+    def record_failure(self, guild_id):
+        failures = self._failures.get(guild_id, 0) + 1
+        self._failures[guild_id] = failures
+        if failures >= self.threshold or guild_id in self._probing:
+            if guild_id not in self._open_until or guild_id in self._probing:
+                self.trips += 1
+                print(f"⛔ Circuit breaker mở cho server {guild_id} sau {failures} lỗi liên tiếp")
+            self._open_until[guild_id] = time.monotonic() + self.cooldown
+            self._probing.discard(guild_id)
+
+    def release(self, guild_id):
+        """Thử lại sau cooldown kết thúc mà không có kết luận (lỗi tạm thời / lỗi người dùng)"""
+        self._probing.discard(guild_id)
+
+    def open_guilds(self):
+        now = time.monotonic()
+        return [guild_id for guild_id, until in list(self._open_until.items()) if until > now]
+
+    def stats(self):
+        return {'trips': self.trips, 'open': self.open_guilds()}
+
+guild_breaker = GuildCircuitBreaker()
+
+ADD_MEMBER_ROUTE = "PUT /guilds/{guild_id}/members/{user_id}"
+
+async def add_member_request(guild_id: int, user_id: int, access_token: str):
+    """
+    Gửi PUT thêm member, tự chờ theo rate limit. Lỗi tạm thời được thử lại với backoff,
+    lỗi cấp server được tính vào circuit breaker. Trả về dict kết quả kèm `category`.
+    """
+    url = f"{DISCORD_API_BASE}/guilds/{guild_id}/members/{user_id}"
+    headers = {
+        "Authorization": f"Bot {DISCORD_TOKEN}",
+        "Content-Type": "application/json"
+    }
+    data = {
+        "access_token": access_token
+    }
+    result = {'guild_id': int(guild_id), 'user_id': int(user_id), 'success': False, 'status': None, 'message': '', 'attempts': 0, 'category': None}
+    rate_limited_attempts = 0
+    transient_attempts = 0
+    
+    while True:
+        if not guild_breaker.allow(guild_id):
+            result.update(category='circuit_open', message="Bỏ qua: server lỗi liên tục (circuit breaker đang mở)")
+            return result
+        await rate_limiter.acquire(ADD_MEMBER_ROUTE, guild_id)
+        result['attempts'] += 1
+        try:
+            async with http_client.session().put(url, headers=headers, json=data) as response:
+                result['status'] = response.status
+                body = None
+                if response.status not in (201, 204):
+                    error_text = await response.text()
+                    try:
+                        body = json.loads(error_text)
+                    except ValueError:
+                        pass
+                retry_after = rate_limiter.update(ADD_MEMBER_ROUTE, guild_id, response.headers, response.status, body)
+                category = classify_member_add_response(response.status, body)
+                if response.status == 201:
+                    result['message'] = "Thêm thành công"
+                elif response.status == 204:
+                    result['message'] = "User đã có trong server"
+                elif category == 'rate_limited':
+                    result['message'] = f"HTTP 429: rate limited, retry after {retry_after}s"
+                else:
+                    result['message'] = f"HTTP {response.status}: {error_text}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            category = 'transient'
+            result['message'] = f"Lỗi kết nối: {e}"
+        result['category'] = category
+        
+        if category == 'ok':
+            guild_breaker.record_success(guild_id)
+            result['success'] = True
+            return result
+        if category == 'guild_error':
+            guild_breaker.record_failure(guild_id)
+            return result
+        guild_breaker.release(guild_id)
+        if category == 'rate_limited' and rate_limited_attempts < MEMBER_ADD_MAX_429_RETRIES:
+            # Bucket/global đã được đánh dấu, acquire() ở vòng sau sẽ chờ đủ retry_after
+            rate_limited_attempts += 1
+            continue
+        if category == 'transient' and transient_attempts < MEMBER_ADD_MAX_RETRIES:
+            transient_attempts += 1
+            await asyncio.sleep(backoff_delay(transient_attempts))
+            continue
+        return result
+
+# --- MEMBERSHIP INDEX ---
+class MembershipIndex:
+    """
+    Chỉ mục user -> các server của bot mà user đang ở, dựng một lần khi on_ready
+    và cập nhật theo sự kiện gateway. Mỗi user là một bitset trên vị trí của server.
+    """
+    def __init__(self):
+        self._positions = {}    # guild_id -> vị trí bit
+        self._guild_ids = []    # vị trí bit -> guild_id (None nếu đã trống)
+        self._free = []
+        self._bits = {}         # user_id -> bitset
+        self.ready = False
+
+    def _position(self, guild_id):
+        position = self._positions.get(guild_id)
+        if position is None:
+            if self._free:
+                position = self._free.pop()
+                self._guild_ids[position] = guild_id
+            else:
+                position = len(self._guild_ids)
+                self._guild_ids.append(guild_id)
+            self._positions[guild_id] = position
+        return position
+
+    def rebuild(self, guilds):
+        self._positions.clear()
+        self._guild_ids.clear()
+        self._free.clear()
+        self._bits.clear()
+        for guild in guilds:
+            self.add_guild(guild)
+        self.ready = True
+        print(f"🗂️ Membership index: {len(self._bits)} users across {len(self._positions)} guilds")
+
+    def add_guild(self, guild):
+        bit = 1 << self._position(guild.id)
+        for member in guild.members:
+            self._bits[member.id] = self._bits.get(member.id, 0) | bit
+
+    def remove_guild(self, guild_id):
+        position = self._positions.pop(guild_id, None)
+        if position is None:
+            return
+        mask = ~(1 << position)
+        for user_id in list(self._bits):
+            bits = self._bits[user_id] & mask
+            if bits:
+                self._bits[user_id] = bits
+            else:
+                del self._bits[user_id]
+        self._guild_ids[position] = None
+        self._free.append(position)
+
+    def add(self, user_id, guild_id):
+        self._bits[user_id] = self._bits.get(user_id, 0) | (1 << self._position(guild_id))
+
+    def remove(self, user_id, guild_id):
+        position = self._positions.get(guild_id)
+        if position is None or user_id not in self._bits:
+            return
+        bits = self._bits[user_id] & ~(1 << position)
+        if bits:
+            self._bits[user_id] = bits
+        else:
+            del self._bits[user_id]
+
+    def contains(self, user_id, guild_id):
+        position = self._positions.get(int(guild_id))
+        return position is not None and bool(self._bits.get(int(user_id), 0) >> position & 1)
+
+    def count(self, user_id):
+        return bin(self._bits.get(int(user_id), 0)).count('1')
+
+    def guilds_of(self, user_id):
+        bits = self._bits.get(int(user_id), 0)
+        guild_ids = []
+        while bits:
+            low = bits & -bits
+            guild_ids.append(self._guild_ids[low.bit_length() - 1])
+            bits ^= low
+        return guild_ids
+
+    def stats(self):
+        return {'users': len(self._bits), 'guilds': len(self._positions), 'ready': self.ready}
+
+membership_index = MembershipIndex()
+
+# --- CHANNEL NAME INDEX ---
+CHANNEL_SEARCH_LIMIT = 10
+CHANNEL_FUZZY_THRESHOLD = 0.3   # Độ tương đồng trigram tối thiểu cho kết quả gần đúng
+
+def normalize_channel_name(name):
+    return name.strip().lstrip('#').strip().lower()
+
+def channel_slug(name):
+    """Tên kênh text sau khi Discord chuẩn hóa (chữ thường, khoảng trắng thành '-')"""
+    return '-'.join(normalize_channel_name(name).split())
+
+def name_trigrams(name):
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class NameTrie:
+    """Trie trên các tên kênh riêng biệt, dùng cho tìm theo tiền tố"""
+    END = None   # Không phải ký tự nên không thể trùng với một nút con
+
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, name):
+        node = self._root
+        for char in name:
+            node = node.setdefault(char, {})
+        node[self.END] = True
+
+    def remove(self, name):
+        path = [self._root]
+        for char in name:
+            node = path[-1].get(char)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].pop(self.END, None)
+        # Cắt các nhánh không còn tên nào
+        for depth in range(len(name), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][name[depth - 1]]
+
+    def with_prefix(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return
+        stack = [(node, prefix)]
+        while stack:
+            node, name = stack.pop()
+            for char, child in node.items():
+                if char == self.END:
+                    yield name
+                else:
+                    stack.append((child, name + char))
+
+class ChannelNameIndex:
+    """Chỉ mục tên kênh text (đã chuẩn hóa) -> {guild_id: [channel_id]}, dựng khi on_ready và cập nhật theo sự kiện"""
+    def __init__(self):
+        self._by_name = {}      # tên chuẩn hóa -> {guild_id: [channel_id]}
+        self._channels = {}     # channel_id -> (guild_id, tên chuẩn hóa)
+        self._trie = NameTrie()
+        self._trigrams = {}     # trigram -> tập tên chứa nó
+        self.ready = False
+
+    def rebuild(self, guilds):
+        self._by_name.clear()
+        self._channels.clear()
+        self._trie = NameTrie()
+        self._trigrams.clear()
+        for guild in guilds:
+            self.add_guild(guild)
+        self.ready = True
+        print(f"🗂️ Channel index: {len(self._channels)} text channels, {len(self._by_name)} distinct names")
+
+    def add_guild(self, guild):
+        for channel in guild.text_channels:
+            self.add_channel(channel)
+
+    def remove_guild(self, guild_id):
+        for channel_id in [cid for cid, (gid, _) in self._channels.items() if gid == guild_id]:
+            self.remove_channel(channel_id)
+
+    def add_channel(self, channel):
+        if not isinstance(channel, discord.TextChannel):
+            return
+        self.remove_channel(channel.id)
+        name = normalize_channel_name(channel.name)
+        if name not in self._by_name:
+            self._index_name(name)
+        self._by_name.setdefault(name, {}).setdefault(channel.guild.id, []).append(channel.id)
+        self._channels[channel.id] = (channel.guild.id, name)
+
+    def remove_channel(self, channel_id):
+        entry = self._channels.pop(channel_id, None)
+        if entry is None:
+            return
+        guild_id, name = entry
+        guilds = self._by_name[name]
+        guilds[guild_id].remove(channel_id)
+        if not guilds[guild_id]:
+            del guilds[guild_id]
+        if not guilds:
+            del self._by_name[name]
+            self._unindex_name(name)
+
+    def _index_name(self, name):
+        self._trie.insert(name)
+        for trigram in name_trigrams(name):
+            self._trigrams.setdefault(trigram, set()).add(name)
+
+    def _unindex_name(self, name):
+        self._trie.remove(name)
+        for trigram in name_trigrams(name):
+            names = self._trigrams.get(trigram)
+            if names:
+                names.discard(name)
+                if not names:
+                    del self._trigrams[trigram]
+
+    def has(self, name, guild_id):
+        return guild_id in self._by_name.get(normalize_channel_name(name), {})
+
+    def lookup(self, name, guild_ids=None):
+        """Trả về {guild_id: [channel_id]} của các kênh có đúng tên `name`, lọc theo `guild_ids` nếu có"""
+        guilds = self._by_name.get(normalize_channel_name(name), {})
+        if guild_ids is None:
+            return {guild_id: list(channel_ids) for guild_id, channel_ids in guilds.items()}
+        return {guild_id: list(guilds[guild_id]) for guild_id in guild_ids if guild_id in guilds}
+
+    def search(self, query, guild_ids=None, limit=CHANNEL_SEARCH_LIMIT):
+        """
+        Tìm kênh theo tên: khớp chính xác, theo tiền tố (trie), chứa chuỗi con hoặc gần đúng (trigram).
+        Trả về tối đa `limit` mục (tên, kiểu khớp, điểm, {guild_id: [channel_id]}) xếp theo điểm giảm dần.
+        """
+        query = normalize_channel_name(query)
+        if not query:
+            return []
+        scores = {}
+        if query in self._by_name:
+            scores[query] = ('exact', 1.0)
+        for name in self._trie.with_prefix(query):
+            if name not in scores:
+                scores[name] = ('prefix', 0.9 + 0.05 * len(query) / len(name))
+
+        query_trigrams = name_trigrams(query)
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self._trigrams.get(trigram, ()))
+        for name, common in shared.items():
+            if name in scores:
+                continue
+            if query in name:
+                scores[name] = ('substring', 0.8 + 0.05 * len(query) / len(name))
+                continue
+            similarity = common / (len(query_trigrams) + len(name_trigrams(name)) - common)
+            if similarity >= CHANNEL_FUZZY_THRESHOLD:
+                scores[name] = ('fuzzy', 0.75 * similarity)
+
+        results = []
+        for name, (kind, score) in sorted(scores.items(), key=lambda item: (-item[1][1], item[0])):
+            matches = self.lookup(name, guild_ids)
+            if matches:
+                results.append((name, kind, score, matches))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def stats(self):
+        return {'channels': len(self._channels), 'names': len(self._by_name), 'ready': self.ready}
+
+channel_index = ChannelNameIndex()
+
+# --- MEMBER ADD ENGINE ---
+async def add_members_bulk(pairs, tokens: dict, concurrency: int = MEMBER_ADD_CONCURRENCY, on_result=None):
+    """
+    Thêm hàng loạt cặp (user_id, guild_id) song song có giới hạn.
+    `tokens` là {user_id (str): access token}; `on_result(result)` được gọi sau mỗi mục.
+    Trả về danh sách dict kết quả theo đúng thứ tự `pairs`.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(user_id, guild_id):
+        access_token = tokens.get(str(user_id))
+        if not access_token:
+            result = {'guild_id': int(guild_id), 'user_id': int(user_id), 'success': False, 'status': None, 'message': "Không có token", 'attempts': 0, 'category': 'no_token'}
+        else:
+            async with semaphore:
+                try:
+                    result = await add_member_request(guild_id, user_id, access_token)
+                except Exception as e:
+                    result = {'guild_id': int(guild_id), 'user_id': int(user_id), 'success': False, 'status': None, 'message': f"Lỗi: {e}", 'attempts': 1, 'category': 'transient'}
+        if not result['success']:
+            print(f"👎 Lỗi khi thêm {user_id} vào server {guild_id}: {result['message']}")
+        if on_result:
+            outcome = on_result(result)
+            if asyncio.iscoroutine(outcome):
+                await outcome
+        return result
+
+    return await asyncio.gather(*(run(user_id, guild_id) for user_id, guild_id in pairs))
+
+def summarize_member_results(results):
+    """Đếm số mục thành công / thất bại từ kết quả add_members_bulk"""
+    success_count = sum(1 for r in results if r['success'])
+    return success_count, len(results) - success_count
+
+def join_lines_limited(lines, limit=1024):
+    """Nối các dòng cho vừa một field embed (tối đa 1024 ký tự), phần dư được tóm tắt là '… và X khác'"""
+    shown = []
+    length = 0
+    for index, line in enumerate(lines):
+        remaining = len(lines) - index
+        suffix = f"\n… và {remaining - 1} khác" if remaining > 1 else ""
+        if length + len(line) + len(suffix) + (1 if shown else 0) > limit:
+            return "\n".join(shown + [f"… và {remaining} khác"])
+        shown.append(line)
+        length += len(line) + (1 if len(shown) > 1 else 0)
+    return "\n".join(shown)
+
+def summarize_failure_categories(results):
+    """Chuỗi thống kê các mục thất bại theo phân loại, dùng trong báo cáo"""
+    counts = Counter(r.get('category') or 'user_error' for r in results if not r['success'])
+    return "\n".join(f"{MEMBER_ADD_CATEGORIES.get(category, category)}: **{count}**" for category, count in counts.most_common())
+
+class MemberAddPlan:
+    """Kết quả lập kế hoạch: cặp (user_id, guild_id) đã có mặt, cần thêm, hoặc thiếu token"""
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.present = []
+        self.to_add = []
+        self.no_token = []
+
+    def summary(self):
+        return f"📋 Kế hoạch: 👍 {len(self.present)} đã có mặt • ➕ {len(self.to_add)} cần thêm • 🔑 {len(self.no_token)} thiếu token"
+
+    def skipped_results(self):
+        """Kết quả cho các cặp không cần gọi API, cùng dạng với add_member_request"""
+        results = [
+            {'guild_id': guild_id, 'user_id': user_id, 'success': True, 'status': None, 'message': "Đã có trong server", 'attempts': 0, 'category': 'ok'}
+            for user_id, guild_id in self.present
+        ]
+        results += [
+            {'guild_id': guild_id, 'user_id': user_id, 'success': False, 'status': None, 'message': "Không có token", 'attempts': 0, 'category': 'no_token'}
+            for user_id, guild_id in self.no_token
+        ]
+        return results
+
+async def plan_member_adds(user_ids, guild_ids):
+    """
+    Tính chính xác tập users × guilds còn thiếu dựa trên membership index,
+    để chỉ gửi phần chênh lệch thật sự tới API.
+    """
+    user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    guild_ids = list(dict.fromkeys(int(guild_id) for guild_id in guild_ids))
+    plan = MemberAddPlan(await storage.get_many(user_ids))
+    for guild_id in guild_ids:
+        for user_id in user_ids:
+            if membership_index.contains(user_id, guild_id):
+                plan.present.append((user_id, guild_id))
+            elif not plan.tokens.get(str(user_id)):
+                plan.no_token.append((user_id, guild_id))
+            else:
+                plan.to_add.append((user_id, guild_id))
+    return plan
+
+# --- PROGRESS REPORTING ---
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m{seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m"
+
+class ProgressReporter:
+    """
+    Hiển thị tiến độ tác vụ hàng loạt bằng cách sửa một tin nhắn duy nhất.
+    Các cập nhật được gộp lại: tối đa một lần sửa mỗi `interval` giây, không tốn rate limit sửa tin nhắn.
+    """
+    def __init__(self, edit, header, total, interval=PROGRESS_EDIT_INTERVAL):
+        self._edit = edit          # Coroutine nhận content=..., ví dụ message.edit hoặc interaction.edit_original_response
+        self.header = header
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self._last_edit = 0.0
+        self._flush_task = None
+        self._flush_sending = False   # Lần sửa tiến độ của _flush_task đã gửi đi, không hủy giữa chừng được nữa
+        self._finished = False
+
+    def record(self, success):
+        if success:
+            self.done += 1
+        else:
+            self.failed += 1
+        if self._flush_task is None and not self._finished:
+            delay = max(0.0, self._last_edit + self.interval - time.monotonic())
+            self._flush_task = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay):
+        try:
+            await asyncio.sleep(delay)
+            self._flush_sending = True
+            await self._send()
+        finally:
+            # Giữ tham chiếu tới khi sửa xong để finish() thấy và chờ được lần sửa đang chạy
+            if self._flush_task is asyncio.current_task():
+                self._flush_task = None
+                self._flush_sending = False
+
+    async def _send(self, final=False):
+        self._last_edit = time.monotonic()
+        try:
+            await self._edit(content=self.render(final))
+        except discord.HTTPException as e:
+            print(f"⚠️ Không thể cập nhật tin nhắn tiến độ: {e}")
+
+    def render(self, final=False):
+        processed = self.done + self.failed
+        remaining = max(self.total - processed, 0)
+        elapsed = max(time.monotonic() - self.started_at, 0.001)
+        rate = processed / elapsed
+        filled = min(10, int(10 * processed / self.total)) if self.total else 10
+        lines = [
+            self.header,
+            f"`{'█' * filled}{'░' * (10 - filled)}` **{processed}/{self.total}** • ✅ {self.done} • ❌ {self.failed} • ⏳ {remaining}",
+        ]
+        if final:
+            lines.append(f"🏁 Hoàn tất sau {format_duration(elapsed)} ({rate:.1f}/s)")
+        else:
+            eta = format_duration(remaining / rate) if rate else "?"
+            lines.append(f"⚡ {rate:.1f}/s • Còn khoảng {eta}")
+        return "\n".join(lines)
+
+    async def finish(self):
+        self._finished = True
+        task, self._flush_task = self._flush_task, None
+        if task:
+            if self._flush_sending:
+                # Chờ lần sửa đang chạy xong để nó không đè lên bản cuối
+                await asyncio.gather(task, return_exceptions=True)
+            else:
+                task.cancel()
+            self._flush_sending = False
+        await self._send(final=True)
+
+# --- JOB QUEUE ---
+JOB_UNFINISHED = ('queued', 'running')
+
+class JobStore:
+    """Lưu tác vụ hàng loạt và trạng thái từng mục trong SQLite để tiếp tục được sau khi restart"""
+    def __init__(self, path=JOB_DB):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    label TEXT,
+                    status TEXT NOT NULL,
+                    channel_id INTEGER,
+                    created_by INTEGER,
+                    created_at REAL,
+                    updated_at REAL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_targets (
+                    job_id INTEGER NOT NULL,
+                    target_key TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    message TEXT,
+                    category TEXT,
+                    PRIMARY KEY (job_id, target_key)
+                )
+            """)
+            # jobs.db cũ được tạo trước khi có cột category
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(job_targets)")}
+            if 'category' not in columns:
+                conn.execute("ALTER TABLE job_targets ADD COLUMN category TEXT")
+            self._conn = conn
+        return self._conn
+
+    def create(self, kind, label, targets, channel_id=None, created_by=None):
+        """Tạo tác vụ với danh sách mục [(target_key, payload dict)], trả về job id"""
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            with conn:
+                conn.execute("BEGIN")
+                cursor = conn.execute(
+                    "INSERT INTO jobs (kind, label, status, channel_id, created_by, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                    (kind, label, channel_id, created_by, now, now)
+                )
+                job_id = cursor.lastrowid
+                conn.executemany(
+                    "INSERT OR IGNORE INTO job_targets (job_id, target_key, payload) VALUES (?, ?, ?)",
+                    [(job_id, key, json.dumps(payload)) for key, payload in targets]
+                )
+        return job_id
+
+    def set_status(self, job_id, status):
+        with self._lock:
+            self._db().execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?", (status, time.time(), job_id))
+
+    def mark_target(self, job_id, target_key, state, message=None, category=None):
+        with self._lock:
+            self._db().execute(
+                "UPDATE job_targets SET state = ?, message = ?, category = ? WHERE job_id = ? AND target_key = ?",
+                (state, message, category, job_id, target_key)
+            )
+
+    def pending_targets(self, job_id, state='pending'):
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT target_key, payload FROM job_targets WHERE job_id = ? AND state = ? ORDER BY rowid",
+                (job_id, state)
+            ).fetchall()
+        return [(key, json.loads(payload)) for key, payload in rows]
+
+    def targets(self, job_id):
+        """Mọi mục của tác vụ, mỗi mục là payload kèm state / message / category / success"""
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT payload, state, message, category FROM job_targets WHERE job_id = ? ORDER BY rowid",
+                (job_id,)
+            ).fetchall()
+        results = []
+        for payload, state, message, category in rows:
+            result = json.loads(payload)
+            result.update(state=state, message=message or '', category=category, success=state == 'done')
+            results.append(result)
+        return results
+
+    def _job_rows(self, where, params):
+        return self._db().execute(f"""
+            SELECT j.id, j.kind, j.label, j.status, j.channel_id, j.created_at,
+                   COUNT(t.target_key),
+                   SUM(CASE WHEN t.state = 'done' THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN t.state = 'failed' THEN 1 ELSE 0 END)
+            FROM jobs j LEFT JOIN job_targets t ON t.job_id = j.id
+            {where}
+            GROUP BY j.id ORDER BY j.id DESC
+        """, params).fetchall()
+
+    @staticmethod
+    def _job_dict(row):
+        return {
+            'id': row[0], 'kind': row[1], 'label': row[2], 'status': row[3], 'channel_id': row[4],
+            'created_at': row[5], 'total': row[6] or 0, 'done': row[7] or 0, 'failed': row[8] or 0,
+        }
+
+    def get(self, job_id):
+        with self._lock:
+            rows = self._job_rows("WHERE j.id = ?", (job_id,))
+        return self._job_dict(rows[0]) if rows else None
+
+    def list_jobs(self, limit=10):
+        with self._lock:
+            rows = self._job_rows("", ())[:limit]
+        return [self._job_dict(row) for row in rows]
+
+    def unfinished(self):
+        with self._lock:
+            rows = self._job_rows("WHERE j.status IN ('queued', 'running')", ())
+        return [self._job_dict(row) for row in reversed(rows)]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+job_store = JobStore()
+atexit.register(job_store.close)
+
+def member_add_targets(pairs):
+    """Chuyển các cặp (user_id, guild_id) thành mục tác vụ"""
+    return [(f"{user_id}:{guild_id}", {'user_id': int(user_id), 'guild_id': int(guild_id)}) for user_id, guild_id in pairs]
+
+def channel_create_targets(guilds, channel_names):
+    """Mỗi cặp (server, tên kênh) là một mục tác vụ; chỉ số giữ cho tên trùng nhau vẫn là mục riêng"""
+    return [
+        (f"{guild.id}:{index}", {'guild_id': guild.id, 'guild_name': guild.name, 'name': name})
+        for guild in guilds
+        for index, name in enumerate(channel_names)
+    ]
+
+def plan_channel_creates(guilds, channel_names):
+    """
+    Chế độ idempotent: chỉ tạo các tên kênh server chưa có (tra channel_index, không gọi API).
+    Trả về (mục tác vụ, số kênh đã có, danh sách server không cần thay đổi).
+    """
+    unique_names = []
+    for name in channel_names:
+        if channel_slug(name) not in {channel_slug(n) for n in unique_names}:
+            unique_names.append(name)
+    targets = []
+    existing = 0
+    unchanged = []
+    for guild in guilds:
+        missing = [(index, name) for index, name in enumerate(unique_names) if not channel_index.has(channel_slug(name), guild.id)]
+        existing += len(unique_names) - len(missing)
+        if not missing:
+            unchanged.append(guild)
+        targets += [
+            (f"{guild.id}:{index}", {'guild_id': guild.id, 'guild_name': guild.name, 'name': name, 'skip_existing': True})
+            for index, name in missing
+        ]
+    return targets, existing, unchanged
+
+async def run_member_add_job(job_id, targets):
+    tokens = await storage.get_many({payload['user_id'] for _, payload in targets})
+    pairs = [(payload['user_id'], payload['guild_id']) for _, payload in targets]
+
+    async def record(result):
+        state = 'done' if result['success'] else 'failed'
+        await job_manager.record_target(job_id, f"{result['user_id']}:{result['guild_id']}", state, result['message'], result.get('category'))
+
+    await add_members_bulk(pairs, tokens, on_result=record)
+
+CREATE_CHANNEL_ROUTE = "POST /guilds/{guild_id}/channels"
+CHANNEL_LIMIT_ERROR_CODE = 30013   # Maximum number of guild channels reached
+
+async def create_channel(guild, name):
+    """
+    Tạo một kênh text. discord.py tự xử lý bucket của route; rate_limiter giữ nhịp toàn cục của bot.
+    POST tạo kênh không idempotent nên không tự thử lại: 5xx / timeout có thể đã tạo kênh rồi,
+    chạy lại !create (chế độ bỏ qua kênh đã có) sẽ chỉ tạo phần còn thiếu.
+    Trả về (success, category, message) với category như MEMBER_ADD_CATEGORIES.
+    """
+    await rate_limiter.acquire(CREATE_CHANNEL_ROUTE, guild.id)
+    try:
+        await guild.create_text_channel(name=name)
+        return True, 'ok', "Đã tạo"
+    except discord.Forbidden:
+        return False, 'guild_error', "Thiếu quyền Manage Channels"
+    except discord.HTTPException as e:
+        if e.code == CHANNEL_LIMIT_ERROR_CODE:
+            return False, 'guild_error', "Server đã đạt giới hạn số kênh"
+        if e.status < 500:
+            return False, 'user_error', f"HTTP {e.status}: {e.text}"
+        return False, 'transient', f"HTTP {e.status}: {e.text} (kênh có thể đã được tạo)"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return False, 'transient', f"Lỗi kết nối: {e} (kênh có thể đã được tạo)"
+
+async def run_create_channels_job(job_id, targets, concurrency=CHANNEL_CREATE_CONCURRENCY):
+    """Các server chạy song song (tối đa `concurrency` server), kênh trong một server được tạo tuần tự theo thứ tự"""
+    by_guild = {}
+    for key, payload in targets:
+        by_guild.setdefault(payload['guild_id'], []).append((key, payload))
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run_guild(guild_id, guild_targets):
+        async with semaphore:
+            guild = bot.get_guild(guild_id)
+            abort = None if guild else ('guild_error', "Bot không còn trong server")
+            for key, payload in guild_targets:
+                if abort:
+                    # Lỗi cấp server: các kênh còn lại chắc chắn thất bại, không gọi API nữa
+                    category, message = abort
+                    success = False
+                elif payload.get('skip_existing') and channel_index.has(channel_slug(payload['name']), guild_id):
+                    # Kênh đã xuất hiện kể từ lúc lập kế hoạch (ví dụ tác vụ được chạy tiếp sau restart)
+                    success, category, message = True, 'ok', "Đã có sẵn"
+                else:
+                    # Đánh dấu trước khi gọi API để biết mục nào đang dở nếu bot restart giữa chừng
+                    await job_manager.record_target(job_id, key, 'running')
+                    success, category, message = await create_channel(guild, payload['name'])
+                    if category == 'guild_error':
+                        abort = (category, message)
+                if not success:
+                    print(f"👎 Không thể tạo kênh '{payload['name']}' trong server {payload['guild_name']}: {message}")
+                await job_manager.record_target(job_id, key, 'done' if success else 'failed', message, category)
+
+    await asyncio.gather(*(run_guild(guild_id, guild_targets) for guild_id, guild_targets in by_guild.items()))
+
+def summarize_channel_failures(results, limit=15):
+    """Thống kê lỗi tạo kênh theo từng server"""
+    failures = {}
+    for r in results:
+        if not r['success']:
+            failures.setdefault(r['guild_name'], []).append(r['message'])
+    lines = []
+    for guild_name, messages in sorted(failures.items(), key=lambda item: -len(item[1])):
+        reasons = ", ".join(f"{message} ×{count}" for message, count in Counter(messages).most_common(2))
+        lines.append(f"• **{guild_name}**: {len(messages)} lỗi — {reasons[:150]}")
+    if len(lines) > limit:
+        lines = lines[:limit] + [f"... và {len(lines) - limit} server khác"]
+    return "\n".join(lines)
+
+async def submit_member_add_plan(plan, label, channel_id=None, created_by=None, reporter=None):
+    """Chạy phần cần thêm của kế hoạch thành một tác vụ; trả về kết quả gồm cả các cặp được bỏ qua"""
+    results = plan.skipped_results()
+    if plan.to_add:
+        job_id = await job_manager.submit('member_add', label, member_add_targets(plan.to_add), channel_id, created_by, reporter)
+        results += await job_manager.wait(job_id)
+    elif reporter:
+        await reporter.finish()
+    return results
+
+async def reconcile_create_channels(job_id, targets):
+    """Mục đang tạo dở lúc restart: nếu kênh đã có trên server thì coi như xong, không tạo lại"""
+    for key, payload in targets:
+        if channel_index.has(channel_slug(payload['name']), payload['guild_id']):
+            await job_manager.record_target(job_id, key, 'done', "Đã tạo (xác nhận sau restart)", 'ok')
+        else:
+            await storage.run(job_store.mark_target, job_id, key, 'pending')
+
+JOB_HANDLERS = {
+    'member_add': run_member_add_job,
+    'create_channels': run_create_channels_job,
+}
+
+# Đối chiếu các mục 'running' khi chạy tiếp; thêm member không cần vì PUT idempotent (204 nếu đã có)
+JOB_RECONCILERS = {
+    'create_channels': reconcile_create_channels,
+}
+
+class JobManager:
+    """Chạy các tác vụ trong JobStore trên event loop; tác vụ dở dang được chạy tiếp khi bot khởi động lại"""
+    def __init__(self):
+        self._tasks = {}
+        self._finished = {}
+        self._reporters = {}
+
+    async def submit(self, kind, label, targets, channel_id=None, created_by=None, reporter=None):
+        job_id = await storage.run(job_store.create, kind, label, targets, channel_id, created_by)
+        if reporter:
+            self._reporters[job_id] = reporter
+        self._start(job_id, kind)
+        return job_id
+
+    async def record_target(self, job_id, target_key, state, message=None, category=None):
+        await storage.run(job_store.mark_target, job_id, target_key, state, message, category)
+        reporter = self._reporters.get(job_id)
+        if reporter and state in ('done', 'failed'):
+            reporter.record(state == 'done')
+
+    def _start(self, job_id, kind, notify=False):
+        if job_id in self._tasks:
+            return
+        self._finished[job_id] = asyncio.Event()
+        self._tasks[job_id] = asyncio.create_task(self._run(job_id, kind, notify))
+
+    async def _run(self, job_id, kind, notify):
+        status = 'failed'
+        try:
+            await storage.run(job_store.set_status, job_id, 'running')
+            interrupted = await storage.run(job_store.pending_targets, job_id, 'running')
+            if interrupted:
+                reconcile = JOB_RECONCILERS.get(kind)
+                if reconcile:
+                    await reconcile(job_id, interrupted)
+                else:
+                    for key, _ in interrupted:
+                        await storage.run(job_store.mark_target, job_id, key, 'pending')
+            targets = await storage.run(job_store.pending_targets, job_id)
+            await JOB_HANDLERS[kind](job_id, targets)
+            status = 'completed'
+        except asyncio.CancelledError:
+            status = 'cancelled'
+        except Exception as e:
+            print(f"❌ Job #{job_id} ({kind}) error: {e}")
+        finally:
+            await storage.run(job_store.set_status, job_id, status)
+            self._tasks.pop(job_id, None)
+            reporter = self._reporters.pop(job_id, None)
+            if reporter:
+                await reporter.finish()
+            # Người đang chờ giữ sẵn Event nên vẫn được đánh thức; wait() gọi sau đó thấy tác vụ đã xong
+            self._finished.pop(job_id).set()
+        if notify:
+            await self._notify(job_id)
+
+    async def _notify(self, job_id):
+        """Báo kết quả tác vụ được tiếp tục sau restart (không còn View nào chờ nó)"""
+        job = await storage.run(job_store.get, job_id)
+        channel = bot.get_channel(job['channel_id']) if job and job['channel_id'] else None
+        if channel is None:
+            return
+        embed = discord.Embed(title=f"📋 Tác vụ #{job_id} đã tiếp tục và kết thúc ({job['status']})", description=job['label'], color=0x0099ff)
+        embed.add_field(name="✅ Thành công", value=str(job['done']), inline=True)
+        embed.add_field(name="❌ Thất bại", value=str(job['failed']), inline=True)
+        try:
+            await channel.send(embed=embed)
+        except discord.HTTPException as e:
+            print(f"Không thể gửi báo cáo tác vụ #{job_id}: {e}")
+
+    async def wait(self, job_id):
+        """Chờ tác vụ kết thúc, trả về kết quả từng mục"""
+        finished = self._finished.get(job_id)
+        if finished:
+            await finished.wait()
+        return await storage.run(job_store.targets, job_id)
+
+    async def cancel(self, job_id):
+        task = self._tasks.get(job_id)
+        if task:
+            task.cancel()
+            return True
+        job = await storage.run(job_store.get, job_id)
+        if job and job['status'] in JOB_UNFINISHED:
+            await storage.run(job_store.set_status, job_id, 'cancelled')
+            return True
+        return False
+
+    async def resume_all(self):
+        for job in await storage.run(job_store.unfinished):
+            if job['id'] not in self._tasks and job['kind'] in JOB_HANDLERS:
+                print(f"🔁 Resuming job #{job['id']} ({job['kind']}): {job['total'] - job['done'] - job['failed']} targets left")
+                self._start(job['id'], job['kind'], notify=True)
+
+job_manager = JobManager()
+
+# --- AVATAR CACHE ---
+def avatar_url(user_id, avatar_hash, size):
+    return f"https://cdn.discordapp.com/avatars/{user_id}/{avatar_hash}.png?size={size}"
+
+class AvatarCache:
+    """
+    Cache avatar 2 tầng theo khóa (user_id, avatar_hash, size): LRU ảnh đã decode trong RAM
+    và file PNG trên đĩa. Hash nằm trong khóa nên đổi avatar là tự thành khóa mới.
+    """
+    def __init__(self, directory=AVATAR_CACHE_DIR, maxsize=AVATAR_CACHE_SIZE):
+        self.directory = directory
+        self.maxsize = maxsize
+        self._memory = OrderedDict()   # (user_id, avatar_hash, size) -> PIL Image
+        self._files = {}               # (user_id, size) -> avatar_hash của file đang có trên đĩa
+        self._lock = threading.Lock()
+        self._directory_ready = False  # Thư mục chỉ được tạo ở lần ghi đầu tiên
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(user_id, avatar_hash, size):
+        return (str(user_id), avatar_hash, int(size))
+
+    def _path(self, key):
+        user_id, avatar_hash, size = key
+        return os.path.join(self.directory, f"{user_id}_{avatar_hash}_{size}.png")
+
+    def _remember(self, key, image):
+        with self._lock:
+            self._memory[key] = image
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+    def get(self, user_id, avatar_hash, size):
+        """Ảnh từ RAM hoặc đĩa, None nếu chưa có (không gọi mạng)"""
+        key = self._key(user_id, avatar_hash, size)
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return image
         try:
-            return psycopg2.connect(DATABASE_URL, sslmode='require')
+            with open(self._path(key), 'rb') as f:
+                image = Image.open(io.BytesIO(f.read())).convert("RGBA")
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
         except Exception as e:
-            print(f"Database connection error: {e}")
+            print(f"⚠️ Avatar cache file lỗi, bỏ qua {self._path(key)}: {e}")
+            with self._lock:
+                self.misses += 1
             return None
-    return None
+        self._remember(key, image)
+        with self._lock:
+            self.disk_hits += 1
+            self._files.setdefault((key[0], key[2]), key[1])
+        return image
 
-def get_user_access_token_db(user_id: str):
-    """Lấy access token từ database"""
-    conn = get_db_connection()
-    if conn:
+    def put(self, user_id, avatar_hash, size, png_bytes):
+        """Decode và lưu ảnh vào cả 2 tầng; xóa file của avatar cũ cùng user / size"""
+        key = self._key(user_id, avatar_hash, size)
+        image = Image.open(io.BytesIO(png_bytes)).convert("RGBA")
+        self._remember(key, image)
+        path = self._path(key)
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT access_token FROM user_tokens WHERE user_id = %s", (user_id,))
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            return result[0] if result else None
-        except Exception as e:
-            print(f"Database error: {e}")
-            if conn:
-                conn.close()
-    return None
+            if not self._directory_ready:
+                os.makedirs(self.directory, exist_ok=True)
+                self._directory_ready = True
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(png_bytes)
+            os.replace(tmp_path, path)
+            with self._lock:
+                previous = self._files.get((key[0], key[2]))
+                self._files[(key[0], key[2])] = key[1]
+            if previous is not None and previous != key[1]:
+                try:
+                    os.remove(self._path((key[0], previous, key[2])))
+                except FileNotFoundError:
+                    pass
+        except OSError as e:
+            print(f"⚠️ Không thể ghi avatar cache {path}: {e}")
+        return image
 
-def save_user_token_db(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
-    """Lưu access token vào database"""
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO user_tokens (user_id, access_token, username, avatar_hash) 
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (user_id) 
-                DO UPDATE SET 
-                    access_token = EXCLUDED.access_token,
-                    username = EXCLUDED.username,
-                    avatar_hash = EXCLUDED.avatar_hash,
-                    updated_at = CURRENT_TIMESTAMP
-            ''', (user_id, access_token, username, avatar_hash))
-            conn.commit()
-            cursor.close()
-            conn.close()
-            print(f"✅ Saved token for user {user_id} to database")
-            return True
-        except Exception as e:
-            print(f"Database error: {e}")
-            if conn:
-                conn.close()
-    return False
+    def stats(self):
+        with self._lock:
+            return {
+                'memory': len(self._memory),
+                'max': self.maxsize,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
 
-# --- FALLBACK JSON FUNCTIONS (kept for compatibility) ---
-def get_user_access_token_json(user_id: str):
-    """Backup: Lấy token từ file JSON"""
+avatar_cache = AvatarCache()
+
+async def fetch_avatar(user_id, avatar_hash, size, timeout=AVATAR_FETCH_TIMEOUT):
+    """Lấy avatar từ cache, chỉ tải từ CDN (không chặn event loop) khi cả 2 tầng đều miss. None nếu lỗi / quá thời gian."""
+    loop = asyncio.get_running_loop()
     try:
-        with open('tokens.json', 'r') as f:
-            tokens = json.load(f)
-            data = tokens.get(str(user_id))
-            if isinstance(data, dict):
-                return data.get('access_token')
-            return data
-    except (FileNotFoundError, json.JSONDecodeError):
+        image = await loop.run_in_executor(None, avatar_cache.get, user_id, avatar_hash, size)
+        if image is not None:
+            return image
+        async with http_client.session().get(avatar_url(user_id, avatar_hash, size), timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            png_bytes = await response.read()
+        return await loop.run_in_executor(None, avatar_cache.put, user_id, avatar_hash, size, png_bytes)
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+        print(f"Could not load avatar for {user_id}: {e!r}")
         return None
 
-def save_user_token_json(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
-    """Backup: Lưu token vào file JSON"""
-    try:
-        try:
-            with open('tokens.json', 'r') as f:
-                tokens = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            tokens = {}
-        
-        tokens[user_id] = {
-            'access_token': access_token,
-            'username': username,
-            'avatar_hash': avatar_hash,
-            'updated_at': str(time.time())
+def placeholder_avatar(size, username):
+    """Ô thay thế cho avatar lỗi / chưa có: nền xám với chữ cái đầu của tên"""
+    tile = Image.new('RGBA', (size, size), (114, 118, 125, 255))
+    draw = ImageDraw.Draw(tile)
+    initial = (username or '?').strip()[:1].upper() or '?'
+    left, top, right, bottom = draw.textbbox((0, 0), initial)
+    draw.text(((size - (right - left)) / 2, (size - (bottom - top)) / 2), initial, fill=(255, 255, 255, 255))
+    return tile
+
+async def fetch_page_avatars(agents, size):
+    """Tải song song avatar của một trang roster; mục lỗi / chưa có avatar trả về None để vẽ placeholder"""
+    async def fetch(agent):
+        if not agent.get('avatar_hash'):
+            return None
+        return await fetch_avatar(agent['id'], agent['avatar_hash'], size)
+
+    return await asyncio.gather(*(fetch(agent) for agent in agents))
+
+def compose_roster_image(avatars, usernames, size, padding):
+    """Ghép avatar thành một hàng và encode PNG (chạy trong worker thread, không chạm event loop)"""
+    canvas = Image.new('RGBA', ((size + padding) * len(avatars) + padding, size + padding * 2), (44, 47, 51, 255))
+    current_x = padding
+    for avatar_img, username in zip(avatars, usernames):
+        if avatar_img is None:
+            avatar_img = placeholder_avatar(size, username)
+        elif avatar_img.size != (size, size):
+            avatar_img = avatar_img.resize((size, size))
+        canvas.paste(avatar_img, (current_x, padding))
+        current_x += size + padding
+    buffer = io.BytesIO()
+    canvas.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+class RosterRenderer:
+    """Render ảnh roster trong thread pool riêng, giới hạn số trang render đồng thời và đo thời gian render"""
+    def __init__(self, workers=ROSTER_RENDER_WORKERS, concurrency=ROSTER_RENDER_CONCURRENCY):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='roster-render')
+        self.concurrency = max(1, concurrency)
+        self._semaphore = None   # Tạo trong event loop của bot ở lần render đầu
+        self.renders = 0
+        self.errors = 0
+        self.total_render_time = 0.0
+        self.max_render_time = 0.0
+        self.total_wait_time = 0.0
+
+    async def render(self, avatars, usernames, size, padding):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        queued_at = time.monotonic()
+        async with self._semaphore:
+            started_at = time.monotonic()
+            self.total_wait_time += started_at - queued_at
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self._executor, compose_roster_image, avatars, usernames, size, padding)
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                elapsed = time.monotonic() - started_at
+                self.renders += 1
+                self.total_render_time += elapsed
+                self.max_render_time = max(self.max_render_time, elapsed)
+
+    def stats(self):
+        return {
+            'renders': self.renders,
+            'errors': self.errors,
+            'avg_ms': round(self.total_render_time / self.renders * 1000, 1) if self.renders else 0.0,
+            'max_ms': round(self.max_render_time * 1000, 1),
+            'avg_wait_ms': round(self.total_wait_time / self.renders * 1000, 1) if self.renders else 0.0,
         }
-        
-        with open('tokens.json', 'w') as f:
-            json.dump(tokens, f, indent=4)
-        print(f"✅ Saved token for user {user_id} to JSON file")
-        return True
-    except Exception as e:
-        print(f"JSON file error: {e}")
-        return False
 
-# --- UNIFIED TOKEN FUNCTIONS ---
-def get_user_access_token(user_id: int):
-    """Lấy access token (Ưu tiên: Database > JSONBin.io > JSON file)"""
-    user_id_str = str(user_id)
-    
-    # Try database first
-    token = get_user_access_token_db(user_id_str)
-    if token:
-        return token
-    
-    # Try JSONBin.io
-    if JSONBIN_API_KEY:
-        token = jsonbin_storage.get_user_token(user_id_str)
-        if token:
-            return token
-    
-    # Fallback to JSON file (for local development)
-    return get_user_access_token_json(user_id_str)
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
 
-def save_user_token(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
-    """Lưu access token (Database + JSONBin.io + JSON backup)"""
-    success_db = save_user_token_db(user_id, access_token, username, avatar_hash)
-    success_jsonbin = False
-    success_json = False
-    
-    # Try JSONBin.io
-    if JSONBIN_API_KEY:
-        success_jsonbin = jsonbin_storage.save_user_token(user_id, access_token, username, avatar_hash)
-    
-    # Local JSON backup (for development)
-    success_json = save_user_token_json(user_id, access_token, username, avatar_hash)
-    
-    return success_db or success_jsonbin or success_json
+roster_renderer = RosterRenderer()
 
-def delete_user_from_db(user_id: str):
-    """Xóa user khỏi database"""
-    conn = get_db_connection()
-    if conn:
+class RosterPageCache:
+    """LRU các trang roster đã render (PNG + mô tả), dùng chung cho mọi phiên !roster"""
+    def __init__(self, maxsize=ROSTER_PAGE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._pages = OrderedDict()   # khóa trang -> (png_bytes, description_text)
+        self._inflight = {}           # khóa trang -> task đang render, để prefetch và lượt bấm không render trùng
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def page_key(page_agents, size):
+        """Hash của ID + avatar hash; kèm tên và số server vì chúng nằm trong ảnh placeholder / mô tả"""
+        material = "|".join(
+            f"{agent['id']}:{agent.get('avatar_hash')}:{agent['username']}:{membership_index.count(agent['id'])}"
+            for agent in page_agents
+        )
+        return hashlib.sha1(f"{size}|{material}".encode()).hexdigest()
+
+    async def get_or_render(self, key, render):
+        """`render()` trả về (page, cacheable); trang có avatar tải lỗi không được cache để lần sau thử lại"""
+        page = self._pages.get(key)
+        if page is not None:
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return page
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._render(key, render))
+            self._inflight[key] = task
+        else:
+            self.hits += 1
+        return await asyncio.shield(task)
+
+    async def _render(self, key, render):
         try:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM user_tokens WHERE user_id = %s", (user_id,))
-            conn.commit()
-            cursor.close()
-            conn.close()
-            print(f"✅ Deleted user {user_id} from database")
-            return True
-        except Exception as e:
-            print(f"Database delete error: {e}")
-            if conn:
-                conn.close()
-    return False
+            page, cacheable = await render()
+            if cacheable:
+                self._pages[key] = page
+                self._pages.move_to_end(key)
+                while len(self._pages) > self.maxsize:
+                    self._pages.popitem(last=False)
+            return page
+        finally:
+            self._inflight.pop(key, None)
 
-def delete_user_from_json(user_id: str):
-    """Xóa user khỏi file JSON"""
-    try:
-        with open('tokens.json', 'r') as f:
-            tokens = json.load(f)
-
-        if user_id in tokens:
-            del tokens[user_id]
-            with open('tokens.json', 'w') as f:
-                json.dump(tokens, f, indent=4)
-            print(f"✅ Deleted user {user_id} from JSON file")
-        return True
-    except (FileNotFoundError, json.JSONDecodeError):
-        return True # File không tồn tại coi như đã xóa
-    except Exception as e:
-        print(f"JSON file delete error: {e}")
-        return False
-        
-# --- DISCORD BOT SETUP ---
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents, owner_id=1311892636650438717, help_command=None)
+    def stats(self):
+        return {'size': len(self._pages), 'max': self.maxsize, 'hits': self.hits, 'misses': self.misses}
 
-# --- FLASK WEB SERVER SETUP ---
-app = Flask(__name__)
+roster_page_cache = RosterPageCache()
 
-# --- UTILITY FUNCTIONS ---
-async def add_member_to_guild(guild_id: int, user_id: int, access_token: str):
-    """Thêm member vào guild sử dụng Discord API trực tiếp"""
-    url = f"https://discord.com/api/v10/guilds/{guild_id}/members/{user_id}"
-    headers = {
-        "Authorization": f"Bot {DISCORD_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "access_token": access_token
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.put(url, headers=headers, json=data) as response:
-            if response.status == 201:
-                return True, "Thêm thành công"
-            elif response.status == 204:
-                return True, "User đã có trong server"
-            else:
-                error_text = await response.text()
-                return False, f"HTTP {response.status}: {error_text}"
-                
 # --- INTERACTIVE UI COMPONENTS ---
 
 # Lớp này định nghĩa giao diện lựa chọn server
@@ -456,20 +2953,19 @@ class ServerSelectView(discord.ui.View):
             item.disabled = True
         await interaction.response.edit_message(view=self)
         
-        await interaction.followup.send(f"✅ Đã nhận lệnh! Bắt đầu mời **{self.target_user.name}** vào **{len(self.selected_guild_ids)}** server đã chọn...")
+        header = f"✅ Đã nhận lệnh! Bắt đầu mời **{self.target_user.name}** vào **{len(self.selected_guild_ids)}** server đã chọn..."
+        progress_message = await interaction.followup.send(header, wait=True)
 
-        access_token = get_user_access_token(self.target_user.id)
+        access_token = await storage.get(self.target_user.id)
         if not access_token:
             await interaction.followup.send(f"❌ Người dùng **{self.target_user.name}** chưa ủy quyền cho bot.")
             return
 
-        success_count, fail_count = 0, 0
-        for guild_id in self.selected_guild_ids:
-            success, message = await add_member_to_guild(guild_id, self.target_user.id, access_token)
-            if success:
-                success_count += 1
-            else:
-                fail_count += 1
+        plan = await plan_member_adds([self.target_user.id], self.selected_guild_ids)
+        header = f"{header}\n{plan.summary()}"
+        reporter = ProgressReporter(progress_message.edit, header, len(plan.to_add))
+        results = await submit_member_add_plan(plan, f"Invite {self.target_user.name}", interaction.channel_id, self.author.id, reporter)
+        success_count, fail_count = summarize_member_results(results)
         
         embed = discord.Embed(title=f"📊 Kết quả mời {self.target_user.name}", color=0x00ff00)
         embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
@@ -486,43 +2982,34 @@ class RosterPages(discord.ui.View):
         self.items_per_page = 6  # Hiển thị 6 điệp viên mỗi trang
         self.total_pages = (len(self.agents) + self.items_per_page - 1) // self.items_per_page
         self.message = None
+        self.avatar_size = 128
+        self.padding = 10
+        self._prefetch_tasks = set()
 
-    async def create_page_embed(self, page_num):
-        """Tạo Embed và ảnh ghép cho một trang cụ thể."""
+    def page_agents(self, page_num):
         start_index = page_num * self.items_per_page
-        end_index = start_index + self.items_per_page
-        page_agents = self.agents[start_index:end_index]
+        return self.agents[start_index:start_index + self.items_per_page]
 
-        if not page_agents:
-            return discord.Embed(title="Lỗi", description="Không có dữ liệu cho trang này."), None
+    async def render_page(self, page_num):
+        """Ảnh ghép + mô tả của một trang, lấy từ roster_page_cache nếu đã render"""
+        page_agents = self.page_agents(page_num)
 
-        # --- Logic tạo ảnh ghép cho trang hiện tại ---
-        avatar_size = 128
-        padding = 10
-        
-        canvas = Image.new('RGBA', ((avatar_size + padding) * len(page_agents) + padding, avatar_size + padding * 2), (44, 47, 51, 255))
-        current_x = padding
-        
-        for agent in page_agents:
-            if agent.get('avatar_hash'):
-                avatar_url = f"https://cdn.discordapp.com/avatars/{agent['id']}/{agent['avatar_hash']}.png?size=128"
-                try:
-                    response = requests.get(avatar_url, stream=True)
-                    response.raise_for_status()
-                    avatar_img = Image.open(io.BytesIO(response.content)).convert("RGBA")
-                    canvas.paste(avatar_img, (current_x, padding))
-                except Exception as e:
-                    print(f"Could not load avatar for {agent['id']}: {e}")
-            current_x += avatar_size + padding
-        
-        buffer = io.BytesIO()
-        canvas.save(buffer, 'PNG')
-        buffer.seek(0)
-        discord_file = discord.File(buffer, filename=f"roster_page_{page_num}.png")
-        # --- Kết thúc logic tạo ảnh ---
+        async def render():
+            avatars = await fetch_page_avatars(page_agents, self.avatar_size)
+            png_bytes = await roster_renderer.render(avatars, [agent['username'] for agent in page_agents], self.avatar_size, self.padding)
+            description_list = [f"👤 **{agent['username']}** `(ID: {agent['id']})` • 🌐 {membership_index.count(agent['id'])} server" for agent in page_agents]
+            cacheable = all(avatar is not None for avatar, agent in zip(avatars, page_agents) if agent.get('avatar_hash'))
+            return (png_bytes, "\n".join(description_list)), cacheable
+
+        return await roster_page_cache.get_or_render(RosterPageCache.page_key(page_agents, self.avatar_size), render)
+
+    async def create_page_embed(self, page_num):
+        """Tạo Embed và ảnh ghép cho một trang cụ thể."""
+        if not self.page_agents(page_num):
+            return discord.Embed(title="Lỗi", description="Không có dữ liệu cho trang này."), None
 
-        description_list = [f"👤 **{agent['username']}** `(ID: {agent['id']})`" for agent in page_agents]
-        description_text = "\n".join(description_list)
+        png_bytes, description_text = await self.render_page(page_num)
+        discord_file = discord.File(io.BytesIO(png_bytes), filename=f"roster_page_{page_num}.png")
 
         embed = discord.Embed(
             title=f"AGENT ROSTER ({len(self.agents)} Active)",
@@ -530,10 +3017,24 @@ class RosterPages(discord.ui.View):
             color=discord.Color.dark_grey()
         )
         embed.set_image(url=f"attachment://roster_page_{page_num}.png")
-        embed.set_footer(text=f"Trang {self.current_page + 1}/{self.total_pages}")
+        embed.set_footer(text=f"Trang {page_num + 1}/{self.total_pages}")
         
         return embed, discord_file
 
+    def prefetch_neighbours(self):
+        """Render trước trang kề bên ở nền để lượt bấm tiếp theo lấy thẳng từ cache"""
+        for page_num in (self.current_page + 1, self.current_page - 1):
+            if 0 <= page_num < self.total_pages:
+                task = asyncio.create_task(self._prefetch(page_num))
+                self._prefetch_tasks.add(task)
+                task.add_done_callback(self._prefetch_tasks.discard)
+
+    async def _prefetch(self, page_num):
+        try:
+            await self.render_page(page_num)
+        except Exception as e:
+            print(f"Roster prefetch error (page {page_num + 1}): {e}")
+
     async def update_buttons(self):
         """Cập nhật trạng thái (bật/tắt) của các nút."""
         # Fast backward button (<<)
@@ -550,6 +3051,7 @@ class RosterPages(discord.ui.View):
         embed, file = await self.create_page_embed(self.current_page)
         await self.update_buttons()
         self.message = await self.ctx.send(embed=embed, file=file, view=self)
+        self.prefetch_neighbours()
 
     @discord.ui.button(style=discord.ButtonStyle.secondary, emoji="⏪")
     async def fast_backward(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -558,6 +3060,7 @@ class RosterPages(discord.ui.View):
         embed, file = await self.create_page_embed(self.current_page)
         await self.update_buttons()
         await interaction.response.edit_message(embed=embed, attachments=[file], view=self)
+        self.prefetch_neighbours()
 
     @discord.ui.button(style=discord.ButtonStyle.secondary, emoji="◀️")
     async def slow_backward(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -567,6 +3070,7 @@ class RosterPages(discord.ui.View):
             embed, file = await self.create_page_embed(self.current_page)
             await self.update_buttons()
             await interaction.response.edit_message(embed=embed, attachments=[file], view=self)
+            self.prefetch_neighbours()
         else:
             await interaction.response.defer()
 
@@ -578,6 +3082,7 @@ class RosterPages(discord.ui.View):
             embed, file = await self.create_page_embed(self.current_page)
             await self.update_buttons()
             await interaction.response.edit_message(embed=embed, attachments=[file], view=self)
+            self.prefetch_neighbours()
         else:
             await interaction.response.defer()
 
@@ -588,6 +3093,7 @@ class RosterPages(discord.ui.View):
         embed, file = await self.create_page_embed(self.current_page)
         await self.update_buttons()
         await interaction.response.edit_message(embed=embed, attachments=[file], view=self)
+        self.prefetch_neighbours()
 
 class DeployView(discord.ui.View):
     def __init__(self, author: discord.User, guilds: list[discord.Guild], agents: list[dict]):
@@ -655,25 +3161,24 @@ class DeployView(discord.ui.View):
         
         for item in self.children: item.disabled = True
         await interaction.response.edit_message(view=self)
-        await interaction.followup.send(f"🚀 **Bắt đầu triển khai {len(self.selected_user_ids)} điệp viên tới `{self.selected_guild.name}`...**")
+        header = f"🚀 **Bắt đầu triển khai {len(self.selected_user_ids)} điệp viên tới `{self.selected_guild.name}`...**"
+        progress_message = await interaction.followup.send(header, wait=True)
 
-        success_count, fail_count, failed_users = 0, 0, []
-        for user_id in self.selected_user_ids:
-            access_token = get_user_access_token(user_id)
-            if not access_token:
-                fail_count += 1; failed_users.append(f"<@{user_id}> (Không có token)"); continue
-            
-            try:
-                success, message = await add_member_to_guild(self.selected_guild.id, user_id, access_token)
-                if success: success_count += 1
-                else: fail_count += 1; failed_users.append(f"<@{user_id}> ({message[:50]})")
-            except Exception as e:
-                fail_count += 1; failed_users.append(f"<@{user_id}> (Lỗi: {e})")
+        plan = await plan_member_adds(self.selected_user_ids, [self.selected_guild.id])
+        header = f"{header}\n{plan.summary()}"
+        reporter = ProgressReporter(progress_message.edit, header, len(plan.to_add))
+        results = await submit_member_add_plan(plan, f"Deploy to {self.selected_guild.name}", interaction.channel_id, self.author.id, reporter)
+        success_count, fail_count = summarize_member_results(results)
+        failed_users = [
+            f"<@{r['user_id']}> [{MEMBER_ADD_CATEGORIES.get(r.get('category'), r.get('category') or '?')}] ({r['message'][:50]})"
+            for r in results if not r['success']
+        ]
 
         embed = discord.Embed(title=f"Báo Cáo Triển Khai tới {self.selected_guild.name}", color=0x00ff00)
         embed.add_field(name="✅ Thành Công", value=f"{success_count} điệp viên", inline=True)
         embed.add_field(name="❌ Thất Bại", value=f"{fail_count} điệp viên", inline=True)
-        if failed_users: embed.add_field(name="Chi tiết thất bại", value="\n".join(failed_users), inline=False)
+        if fail_count: embed.add_field(name="Phân loại lỗi", value=summarize_failure_categories(results), inline=False)
+        if failed_users: embed.add_field(name="Chi tiết thất bại", value=join_lines_limited(failed_users), inline=False)
         await interaction.followup.send(embed=embed)
 
 # --- Modal 1: Nhập số lượng kênh ---
@@ -683,43 +3188,54 @@ class QuantityView(discord.ui.View):
         super().__init__(timeout=300)
         self.selected_guilds = selected_guilds
         self.author = author
+        self.skip_existing = True   # Chế độ idempotent: không tạo lại kênh đã có
+
+    @discord.ui.button(label="Bỏ qua kênh đã có: BẬT", style=discord.ButtonStyle.success, emoji="♻️", row=1)
+    async def toggle_skip_existing(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user.id != self.author.id:
+            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
+        self.skip_existing = not self.skip_existing
+        button.label = f"Bỏ qua kênh đã có: {'BẬT' if self.skip_existing else 'TẮT'}"
+        button.style = discord.ButtonStyle.success if self.skip_existing else discord.ButtonStyle.secondary
+        await interaction.response.edit_message(view=self)
 
     @discord.ui.button(label="1 Kênh", style=discord.ButtonStyle.secondary)
     async def one_channel(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.author.id:
             return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 1))
+        await interaction.response.send_modal(NamesModal(self.selected_guilds, 1, self.skip_existing))
 
     @discord.ui.button(label="2 Kênh", style=discord.ButtonStyle.secondary)
     async def two_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.author.id:
             return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 2))
+        await interaction.response.send_modal(NamesModal(self.selected_guilds, 2, self.skip_existing))
 
     @discord.ui.button(label="3 Kênh", style=discord.ButtonStyle.secondary)
     async def three_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.author.id:
             return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 3))
+        await interaction.response.send_modal(NamesModal(self.selected_guilds, 3, self.skip_existing))
 
     @discord.ui.button(label="4 Kênh", style=discord.ButtonStyle.secondary)
     async def four_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.author.id:
             return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 4))
+        await interaction.response.send_modal(NamesModal(self.selected_guilds, 4, self.skip_existing))
 
     @discord.ui.button(label="5 Kênh", style=discord.ButtonStyle.secondary)
     async def five_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.author.id:
             return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 5))
+        await interaction.response.send_modal(NamesModal(self.selected_guilds, 5, self.skip_existing))
 
 # --- Modal để nhập tên riêng cho từng kênh ---
 class NamesModal(discord.ui.Modal):
-    def __init__(self, selected_guilds: list[discord.Guild], quantity: int):
+    def __init__(self, selected_guilds: list[discord.Guild], quantity: int, skip_existing: bool = True):
         super().__init__(title=f"Nhập Tên Cho {quantity} Kênh")
         self.selected_guilds = selected_guilds
         self.quantity = quantity
+        self.skip_existing = skip_existing
         
         # Tạo các TextInput fields dựa trên số lượng
         if quantity >= 1:
@@ -777,24 +3293,38 @@ class NamesModal(discord.ui.Modal):
         if hasattr(self, 'name5'):
             channel_names.append(self.name5.value)
         
-        await interaction.response.send_message(f"✅ **Đã nhận lệnh!** Chuẩn bị tạo **{len(channel_names)}** kênh trong **{len(self.selected_guilds)}** server...", ephemeral=True)
+        header = f"✅ **Đã nhận lệnh!** Chuẩn bị tạo **{len(channel_names)}** kênh trong **{len(self.selected_guilds)}** server..."
+        await interaction.response.send_message(header, ephemeral=True)
 
-        total_success = 0
-        total_fail = 0
+        existing, unchanged = 0, []
+        if self.skip_existing:
+            targets, existing, unchanged = plan_channel_creates(self.selected_guilds, channel_names)
+            header += f"\n♻️ Đã có sẵn: **{existing}** kênh • 🟰 Không đổi: **{len(unchanged)}** server • ➕ Cần tạo: **{len(targets)}** kênh"
+        else:
+            targets = channel_create_targets(self.selected_guilds, channel_names)
         
-        for guild in self.selected_guilds:
-            for name in channel_names:
-                try:
-                    await guild.create_text_channel(name=name)
-                    total_success += 1
-                except discord.Forbidden:
-                    total_fail += 1
-                    print(f"Lỗi quyền: Không thể tạo kênh '{name}' trong server {guild.name}")
-                except Exception as e:
-                    total_fail += 1
-                    print(f"Lỗi không xác định khi tạo kênh '{name}': {e}")
+        results = []
+        if targets:
+            reporter = ProgressReporter(interaction.edit_original_response, header, len(targets))
+            job_id = await job_manager.submit('create_channels', f"Create {len(channel_names)} channels in {len(self.selected_guilds)} servers", targets, interaction.channel_id, interaction.user.id, reporter)
+            results = await job_manager.wait(job_id)
+        else:
+            # Không có kênh nào cần tạo: vẫn hiện kế hoạch để người dùng biết lệnh đã chạy
+            if unchanged:
+                header += "\n🟰 Mọi server đã có đủ kênh, không cần tạo thêm."
+            await interaction.edit_original_response(content=header)
+        total_success = sum(1 for r in results if r['success'])
+        total_fail = len(results) - total_success
         
-        await interaction.followup.send(f"**Báo cáo hoàn tất:**\n✅ Đã tạo thành công: **{total_success}** kênh.\n❌ Thất bại: **{total_fail}** kênh.")
+        report = f"**Báo cáo hoàn tất:**\n✅ Đã tạo thành công: **{total_success}** kênh.\n❌ Thất bại: **{total_fail}** kênh."
+        if self.skip_existing:
+            report += f"\n♻️ Bỏ qua (đã có): **{existing}** kênh.\n🟰 Không đổi: **{len(unchanged)}** server."
+            if unchanged:
+                names = ", ".join(guild.name for guild in unchanged[:10])
+                report += f" ({names}{', ...' if len(unchanged) > 10 else ''})"
+        if total_fail:
+            report += f"\n\n**Chi tiết lỗi theo server:**\n{summarize_channel_failures(results)}"
+        await interaction.followup.send(report[:2000])
 
 # --- View để chọn server và bắt đầu quy trình ---
 class CreateChannelView(discord.ui.View):
@@ -873,24 +3403,27 @@ class ChannelNameModal(discord.ui.Modal, title="Nhập Tên Kênh Cần Tìm"):
 
     channel_name = discord.ui.TextInput(
         label="Tên kênh bạn muốn tìm ID",
-        placeholder="Nhập chính xác tên kênh, không bao gồm dấu #",
+        placeholder="Tên đầy đủ, tiền tố hoặc một phần tên kênh, không bao gồm dấu #",
         required=True
     )
+    search_mode = discord.ui.TextInput(
+        label="Chế độ (trống/search)",
+        placeholder="Trống: tìm chính xác, tự gợi ý nếu không thấy. 'search': luôn tìm gần đúng",
+        required=False,
+        max_length=10
+    )
 
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.send_message(f"🔎 Đang tìm kiếm các kênh có tên `{self.channel_name.value}`...", ephemeral=True)
         
-        results = {}
-        target_name = self.channel_name.value.lower().strip()
-
-        for guild in self.selected_guilds:
-            found_channels = []
-            for channel in guild.text_channels:
-                if channel.name.lower() == target_name:
-                    found_channels.append(channel.id)
-            
-            if found_channels:
-                results[guild.name] = found_channels
+        guild_names = {guild.id: guild.name for guild in self.selected_guilds}
+        matches = {} if self.search_mode.value.strip().lower() == 'search' else channel_index.lookup(self.channel_name.value, guild_names)
+        if not matches:
+            # Không có kết quả chính xác: xếp hạng theo tiền tố / chuỗi con / trigram
+            ranked = channel_index.search(self.channel_name.value, guild_names)
+            if ranked:
+                return await interaction.followup.send(embed=self.build_search_embed(ranked, guild_names))
+        results = {guild_names[guild_id]: channel_ids for guild_id, channel_ids in matches.items()}
 
         # Tạo Embed kết quả
         if not results:
@@ -909,6 +3442,31 @@ class ChannelNameModal(discord.ui.Modal, title="Nhập Tên Kênh Cần Tìm"):
                 embed.add_field(name=f"🖥️ Server: {guild_name}", value=id_string, inline=False)
         
         await interaction.followup.send(embed=embed)
+
+    def build_search_embed(self, ranked, guild_names):
+        kind_labels = {'exact': "chính xác", 'prefix': "tiền tố", 'substring': "chứa", 'fuzzy': "gần đúng"}
+        embed = discord.Embed(
+            title=f"Kết Quả Gần Đúng cho '{self.channel_name.value}'",
+            description=f"Top {len(ranked)} tên kênh khớp nhất trong các server đã chọn.",
+            color=discord.Color.blue()
+        )
+        # Discord giới hạn tổng 6000 ký tự mỗi embed, chừa chỗ cho footer
+        budget = 5500 - len(embed.title) - len(embed.description)
+        for shown, (name, kind, score, matches) in enumerate(ranked):
+            lines = [
+                f"🖥️ {guild_names[guild_id]}: " + ", ".join(f"`{channel_id}`" for channel_id in channel_ids)
+                for guild_id, channel_ids in matches.items()
+            ]
+            value = "\n".join(lines)
+            if len(value) > 1024:
+                value = value[:1000].rsplit("\n", 1)[0] + "\n..."
+            field_name = f"#{name} • {kind_labels[kind]} ({score:.0%})"
+            budget -= len(field_name) + len(value)
+            if budget < 0:
+                embed.set_footer(text=f"... và {len(ranked) - shown} kết quả khác, hãy nhập tên cụ thể hơn.")
+                break
+            embed.add_field(name=field_name, value=value, inline=False)
+        return embed
         
 # --- View để lấy ID kênh (Đã sửa lỗi phân trang) ---
 class GetChannelIdView(discord.ui.View):
@@ -965,18 +3523,56 @@ async def on_ready():
     print(f'🔑 Redirect URI: {REDIRECT_URI}')
     
     # Check storage status
-    db_status = "Connected" if get_db_connection() else "Unavailable"
-    jsonbin_status = "Connected" if JSONBIN_API_KEY else "Not configured"
+    db_status = storage_health.describe('db')
+    jsonbin_status = storage_health.describe('jsonbin')
     print(f'💾 Database: {db_status}')
     print(f'🌐 JSONBin.io: {jsonbin_status}')
     
+    membership_index.rebuild(bot.guilds)
+    channel_index.rebuild(bot.guilds)
+    
     try:
         synced = await bot.tree.sync()
         print(f"✅ Đã đồng bộ {len(synced)} lệnh slash.")
     except Exception as e:
         print(f"❌ Không thể đồng bộ lệnh slash: {e}")
+    
+    # Tiếp tục các tác vụ hàng loạt bị dừng giữa chừng do restart
+    await job_manager.resume_all()
     print('------')
 
+@bot.event
+async def on_member_join(member):
+    membership_index.add(member.id, member.guild.id)
+
+@bot.event
+async def on_member_remove(member):
+    membership_index.remove(member.id, member.guild.id)
+
+@bot.event
+async def on_guild_join(guild):
+    membership_index.add_guild(guild)
+    channel_index.add_guild(guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    membership_index.remove_guild(guild.id)
+    channel_index.remove_guild(guild.id)
+
+@bot.event
+async def on_guild_channel_create(channel):
+    channel_index.add_channel(channel)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    channel_index.remove_channel(channel.id)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name or type(before) is not type(after):
+        channel_index.remove_channel(before.id)
+        channel_index.add_channel(after)
+
 # --- DISCORD BOT COMMANDS ---
 @bot.command(name='ping', help='Kiểm tra độ trễ kết nối của bot.')
 async def ping(ctx):
@@ -1026,7 +3622,7 @@ async def settoken(ctx, *, token: str = None):
     username = ctx.author.name
     
     # Lưu token mà không cần avatar_hash
-    success = save_user_token(user_id, token.strip(), username)
+    success = await storage.save(user_id, token.strip(), username)
     
     if success:
         embed = discord.Embed(
@@ -1051,9 +3647,10 @@ async def settoken(ctx, *, token: str = None):
 @bot.command(name='add_me', help='Thêm bạn vào tất cả các server của bot.')
 async def add_me(ctx):
     user_id = ctx.author.id
-    await ctx.send(f"✅ Bắt đầu quá trình thêm {ctx.author.mention} vào các server...")
+    header = f"✅ Bắt đầu quá trình thêm {ctx.author.mention} vào các server..."
+    progress_message = await ctx.send(header)
     
-    access_token = get_user_access_token(user_id)
+    access_token = await storage.get(user_id)
     if not access_token:
         embed = discord.Embed(
             title="❌ Chưa ủy quyền",
@@ -1063,29 +3660,14 @@ async def add_me(ctx):
         await ctx.send(embed=embed)
         return
     
-    success_count = 0
-    fail_count = 0
+    # Server đã có sẵn user được tính là thành công, chỉ gọi API cho phần còn lại
+    plan = await plan_member_adds([user_id], [guild.id for guild in bot.guilds])
+    print(f"👍 {ctx.author.name}: {plan.summary()}")
     
-    for guild in bot.guilds:
-        try:
-            member = guild.get_member(user_id)
-            if member:
-                print(f"👍 {ctx.author.name} đã có trong server {guild.name}")
-                success_count += 1
-                continue
-            
-            success, message = await add_member_to_guild(guild.id, user_id, access_token)
-            
-            if success:
-                print(f"👍 Thêm thành công {ctx.author.name} vào server {guild.name}: {message}")
-                success_count += 1
-            else:
-                print(f"👎 Lỗi khi thêm vào {guild.name}: {message}")
-                fail_count += 1
-                
-        except Exception as e:
-            print(f"👎 Lỗi không xác định khi thêm vào {guild.name}: {e}")
-            fail_count += 1
+    reporter = ProgressReporter(progress_message.edit, f"{header}\n{plan.summary()}", len(plan.to_add))
+    results = await add_members_bulk(plan.to_add, plan.tokens, on_result=lambda r: reporter.record(r['success']))
+    await reporter.finish()
+    success_count, fail_count = summarize_member_results(plan.skipped_results() + results)
     
     embed = discord.Embed(title="📊 Kết quả", color=0x00ff00)
     embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
@@ -1095,7 +3677,7 @@ async def add_me(ctx):
 @bot.command(name='check_token', help='Kiểm tra xem bạn đã ủy quyền chưa.')
 async def check_token(ctx):
     user_id = ctx.author.id
-    token = get_user_access_token(user_id)
+    token = await storage.get(user_id)
     
     if token:
         embed = discord.Embed(
@@ -1115,20 +3697,18 @@ async def check_token(ctx):
 
 @bot.command(name='status', help='Kiểm tra trạng thái bot và storage.')
 async def status(ctx):
-    # Test database connection
-    db_connection = get_db_connection()
-    db_status = "✅ Connected" if db_connection else "❌ Unavailable"
-    if db_connection:
-        db_connection.close()
-    
-    # Test JSONBin connection
-    jsonbin_status = "✅ Configured" if JSONBIN_API_KEY else "❌ Not configured"
+    # Trạng thái storage lấy từ lần kiểm tra nền gần nhất
+    db_status = storage_health.describe('db')
+    jsonbin_status = storage_health.describe('jsonbin')
     
     embed = discord.Embed(title="🤖 Trạng thái Bot", color=0x0099ff)
     embed.add_field(name="📊 Server", value=f"{len(bot.guilds)} server", inline=True)
     embed.add_field(name="👥 Người dùng", value=f"{len(bot.users)} user", inline=True)
     embed.add_field(name="💾 Database", value=db_status, inline=True)
     embed.add_field(name="🌐 JSONBin.io", value=jsonbin_status, inline=True)
+    render_stats = roster_renderer.stats()
+    page_cache_stats = roster_page_cache.stats()
+    embed.add_field(name="🖼️ Roster render", value=f"{render_stats['renders']} trang • TB {render_stats['avg_ms']}ms • Max {render_stats['max_ms']}ms • Chờ {render_stats['avg_wait_ms']}ms • Cache {page_cache_stats['hits']}/{page_cache_stats['hits'] + page_cache_stats['misses']} hit", inline=False)
     embed.add_field(name="🌍 Web Server", value=f"[Truy cập]({RENDER_URL})", inline=False)
     await ctx.send(embed=embed)
     
@@ -1140,9 +3720,10 @@ async def force_add(ctx, user_to_add: discord.User):
     Cách dùng: !force_add <User_ID> hoặc !force_add @TênNgườiDùng
     """
     user_id = user_to_add.id
-    await ctx.send(f"✅ Đã nhận lệnh! Bắt đầu quá trình thêm {user_to_add.mention} vào các server...")
+    header = f"✅ Đã nhận lệnh! Bắt đầu quá trình thêm {user_to_add.mention} vào các server..."
+    progress_message = await ctx.send(header)
     
-    access_token = get_user_access_token(user_id)
+    access_token = await storage.get(user_id)
     if not access_token:
         embed = discord.Embed(
             title="❌ Người dùng chưa ủy quyền",
@@ -1152,29 +3733,13 @@ async def force_add(ctx, user_to_add: discord.User):
         await ctx.send(embed=embed)
         return
     
-    success_count = 0
-    fail_count = 0
+    # Server đã có sẵn user được tính là thành công, chỉ gọi API cho phần còn lại
+    plan = await plan_member_adds([user_id], [guild.id for guild in bot.guilds])
+    print(f"👍 {user_to_add.name}: {plan.summary()}")
     
-    for guild in bot.guilds:
-        try:
-            member = guild.get_member(user_id)
-            if member:
-                print(f"👍 {user_to_add.name} đã có trong server {guild.name}")
-                success_count += 1
-                continue
-            
-            success, message = await add_member_to_guild(guild.id, user_id, access_token)
-            
-            if success:
-                print(f"👍 Thêm thành công {user_to_add.name} vào server {guild.name}: {message}")
-                success_count += 1
-            else:
-                print(f"👎 Lỗi khi thêm vào {guild.name}: {message}")
-                fail_count += 1
-                
-        except Exception as e:
-            print(f"👎 Lỗi không xác định khi thêm vào {guild.name}: {e}")
-            fail_count += 1
+    reporter = ProgressReporter(progress_message.edit, f"{header}\n{plan.summary()}", len(plan.to_add))
+    results = await submit_member_add_plan(plan, f"Force add {user_to_add.name}", ctx.channel.id, ctx.author.id, reporter)
+    success_count, fail_count = summarize_member_results(results)
     
     embed = discord.Embed(title=f"📊 Kết quả thêm {user_to_add.name}", color=0x00ff00)
     embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
@@ -1241,6 +3806,8 @@ async def help_slash(interaction: discord.Interaction):
         embed.add_field(name="`!remove <User>`", value="Xóa dữ liệu của một điệp viên.", inline=True)
         embed.add_field(name="`!force_add <User>`", value="Ép thêm điệp viên vào TẤT CẢ server.", inline=True)
         embed.add_field(name="`!storage_info`", value="Xem thông tin các hệ thống lưu trữ.", inline=True)
+        embed.add_field(name="`!jobs`", value="Xem / hủy các tác vụ hàng loạt.", inline=True)
+        embed.add_field(name="`!whereis <user>`", value="Xem người dùng đang ở server nào.", inline=True)
 
     embed.set_footer(text="Hãy chọn một mật lệnh để bắt đầu chiến dịch.")
     await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -1272,6 +3839,8 @@ async def help(ctx):
         embed.add_field(name="`!remove <User>`", value="Xóa dữ liệu của một điệp viên.", inline=True)
         embed.add_field(name="`!force_add <User>`", value="Ép thêm điệp viên vào TẤT CẢ server.", inline=True)
         embed.add_field(name="`!storage_info`", value="Xem thông tin các hệ thống lưu trữ.", inline=True)
+        embed.add_field(name="`!jobs`", value="Xem / hủy các tác vụ hàng loạt.", inline=True)
+        embed.add_field(name="`!whereis <user>`", value="Xem người dùng đang ở server nào.", inline=True)
 
     embed.set_footer(text="Hãy chọn một mật lệnh để bắt đầu chiến dịch.")
     await ctx.send(embed=embed)
@@ -1282,50 +3851,105 @@ async def help(ctx):
 async def storage_info(ctx):
     """Hiển thị thông tin chi tiết về các storage systems"""
     
-    # Test Database
-    db_connection = get_db_connection()
-    if db_connection:
-        try:
-            cursor = db_connection.cursor()
-            cursor.execute("SELECT COUNT(*) FROM user_tokens")
-            db_count = cursor.fetchone()[0]
-            cursor.close()
-            db_connection.close()
-            db_info = f"✅ Connected ({db_count} tokens)"
-        except:
-            db_info = "❌ Connection Error"
-    else:
-        db_info = "❌ Not Available"
-    
-    # Test JSONBin
-    if JSONBIN_API_KEY and JSONBIN_BIN_ID:
-        try:
-            data = jsonbin_storage.read_data()
-            jsonbin_count = len(data) if isinstance(data, dict) else 0
-            jsonbin_info = f"✅ Connected ({jsonbin_count} tokens)"
-        except:
-            jsonbin_info = "❌ Connection Error"
-    else:
-        jsonbin_info = "❌ Not Configured"
+    # Đọc kết quả đã cache của StorageHealthProber, chỉ kiểm tra trực tiếp khi chưa có hoặc đã cũ
+    if not storage_health.is_fresh():
+        await storage.run(storage_health.probe_all)
+    db_info = storage_health.describe('db') if db_pool else "❌ Not Available"
+    jsonbin_info = storage_health.describe('jsonbin') if JSONBIN_API_KEY and JSONBIN_BIN_ID else "❌ Not Configured"
     
     embed = discord.Embed(title="💾 Storage Systems Info", color=0x0099ff)
     embed.add_field(name="🗃️ PostgreSQL Database", value=db_info, inline=False)
     embed.add_field(name="🌐 JSONBin.io", value=jsonbin_info, inline=False)
     
+    if db_pool:
+        pool = db_pool.stats()
+        embed.add_field(
+            name="🔌 DB Pool",
+            value=(
+                f"In use: {pool['in_use']}/{pool['max']} • Idle: {pool['idle']} • Waiters: {pool['waiters']}\n"
+                f"Checkouts: {pool['checkouts']} • Avg: {pool['avg_checkout_ms']}ms • Max: {pool['max_checkout_ms']}ms • Timeouts: {pool['timeouts']}"
+            ),
+            inline=False
+        )
+    
+    cache = token_cache.stats()
+    embed.add_field(
+        name="⚡ Token Cache",
+        value=f"{cache['size']}/{cache['max']} entries • Hits: {cache['hits']} • Misses: {cache['misses']} • Hit rate: {cache['hit_rate']}%",
+        inline=False
+    )
+    
+    if JSONBIN_API_KEY:
+        snapshot = jsonbin_storage.snapshot_info()
+        if snapshot['loaded']:
+            embed.add_field(
+                name="🗂️ JSONBin Snapshot",
+                value=f"{snapshot['records']} records • Version: {snapshot['version'] or 'N/A'} • Age: {snapshot['age_seconds']}s • Served from memory: {snapshot['hits']} • Refreshes: {snapshot['refreshes']}",
+                inline=False
+            )
+        writes = jsonbin_storage.stats()
+        embed.add_field(
+            name="📝 JSONBin Write Queue",
+            value=f"Pending: {writes['pending']} • Flushed: {writes['flushed']}/{writes['queued']} changes in {writes['flushes']} PUTs • Failed flushes: {writes['failed_flushes']}",
+            inline=False
+        )
+    
     if JSONBIN_BIN_ID:
         embed.add_field(name="📋 JSONBin Bin ID", value=f"`{JSONBIN_BIN_ID}`", inline=False)
     
-    embed.add_field(name="ℹ️ Hierarchy", value="Database → JSONBin.io → Local JSON", inline=False)
+    embed.add_field(name="🗄️ Local Store (SQLite)", value=f"`{local_store.path}` • {storage_health.describe('local')}", inline=False)
+    
+    tier_stats = tier_write_stats.snapshot()
+    if tier_stats:
+        embed.add_field(
+            name="⏱️ Tier Writes",
+            value="\n".join(
+                f"`{tier}`: {s['writes']} writes • avg {s['avg_ms']}ms • max {s['max_ms']}ms • {s['failures']} failed • {s['retries']} retries • {s['timeouts']} timeouts"
+                for tier, s in tier_stats.items()
+            ),
+            inline=False
+        )
+    
+    membership = membership_index.stats()
+    embed.add_field(
+        name="🗺️ Membership Index",
+        value=f"{membership['users']} users • {membership['guilds']} guilds • {'Ready' if membership['ready'] else 'Not built yet'}",
+        inline=False
+    )
+    
+    channels = channel_index.stats()
+    embed.add_field(
+        name="#️⃣ Channel Index",
+        value=f"{channels['channels']} text channels • {channels['names']} distinct names • {'Ready' if channels['ready'] else 'Not built yet'}",
+        inline=False
+    )
+    
+    avatars = avatar_cache.stats()
+    embed.add_field(
+        name="🖼️ Avatar Cache",
+        value=f"{avatars['memory']}/{avatars['max']} in memory • Memory hits: {avatars['memory_hits']} • Disk hits: {avatars['disk_hits']} • Misses (CDN): {avatars['misses']}",
+        inline=False
+    )
+    
+    breaker = guild_breaker.stats()
+    open_names = [bot.get_guild(guild_id).name if bot.get_guild(guild_id) else str(guild_id) for guild_id in breaker['open'][:10]]
+    embed.add_field(
+        name="⛔ Member-add Circuit Breaker",
+        value=(f"Trips: {breaker['trips']} • Open: {len(breaker['open'])}" + (f" ({', '.join(open_names)})" if open_names else ""))[:1024],
+        inline=False
+    )
+    
+    embed.add_field(name="ℹ️ Hierarchy", value="Cache → Database → JSONBin.io → Local store", inline=False)
     
     await ctx.send(embed=embed)
 
 @bot.command(name='migrate_tokens', help='(Chủ bot) Migrate tokens between storage systems.')
 @commands.is_owner()
-async def migrate_tokens(ctx, source: str = None, target: str = None):
+async def migrate_tokens(ctx, source: str = None, target: str = None, mode: str = None):
     """
     Migrate tokens between storage systems
-    Usage: !migrate_tokens <source> <target>
-    Sources/Targets: db, jsonbin, json
+    Usage: !migrate_tokens <source> <target> [dry]
+    Sources/Targets: db, jsonbin, local
     """
     
     if not source or not target:
@@ -1336,87 +3960,141 @@ async def migrate_tokens(ctx, source: str = None, target: str = None):
         )
         embed.add_field(
             name="Usage", 
-            value="`!migrate_tokens <source> <target>`\n\nValid options:\n• `db` - PostgreSQL Database\n• `jsonbin` - JSONBin.io\n• `json` - Local JSON file", 
+            value="`!migrate_tokens <source> <target> [dry]`\n\nValid options:\n• `db` - PostgreSQL Database\n• `jsonbin` - JSONBin.io\n• `local` - Local store (SQLite, `json` also accepted)\n\nAdd `dry` to preview the changes without writing.", 
             inline=False
         )
         embed.add_field(
             name="Examples", 
-            value="`!migrate_tokens json jsonbin`\n`!migrate_tokens db jsonbin`", 
+            value="`!migrate_tokens local jsonbin`\n`!migrate_tokens db jsonbin dry`", 
             inline=False
         )
         await ctx.send(embed=embed)
         return
     
-    await ctx.send(f"🔄 Starting migration from {source} to {target}...")
+    source = MIGRATION_TIER_ALIASES.get(source.lower(), source.lower())
+    target = MIGRATION_TIER_ALIASES.get(target.lower(), target.lower())
+    if source not in MIGRATION_TIERS or target not in MIGRATION_TIERS or source == target:
+        await ctx.send(f"❌ Invalid migration `{source}` → `{target}`. Valid options: {', '.join(MIGRATION_TIERS)}")
+        return
+    dry_run = mode is not None and mode.lower() in ('dry', 'dry-run', '--dry-run')
+    
+    status_message = await ctx.send(f"🔄 Starting {'dry-run ' if dry_run else ''}migration from {source} to {target}...")
     
     # Get source data
-    source_data = {}
-    if source == "db":
-        conn = get_db_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT user_id, access_token, username FROM user_tokens")
-                rows = cursor.fetchall()
-                for row in rows:
-                    source_data[row[0]] = {
-                        'access_token': row[1],
-                        'username': row[2],
-                        'updated_at': str(time.time())
-                    }
-                cursor.close()
-                conn.close()
-            except Exception as e:
-                await ctx.send(f"❌ Database read error: {e}")
-                return
-    elif source == "jsonbin":
-        try:
-            source_data = jsonbin_storage.read_data()
-        except Exception as e:
-            await ctx.send(f"❌ JSONBin read error: {e}")
-            return
-    elif source == "json":
+    try:
+        raw_source = await storage.run(load_tokens, source)
+    except Exception as e:
+        await ctx.send(f"❌ {source} read error: {e}")
+        return
+    
+    if not raw_source:
+        await ctx.send(f"❌ No data found in {source}")
+        return
+    
+    records = {}
+    for user_id, token_data in raw_source.items():
+        record = normalize_token_record(token_data)
+        if record:
+            records[str(user_id)] = record
+    skipped_count = len(raw_source) - len(records)
+    
+    # Dry-run: chỉ so sánh với dữ liệu hiện có ở đích
+    if dry_run:
         try:
-            with open('tokens.json', 'r') as f:
-                source_data = json.load(f)
+            target_data = await storage.run(load_tokens, target)
         except Exception as e:
-            await ctx.send(f"❌ JSON file read error: {e}")
+            await ctx.send(f"❌ {target} read error: {e}")
             return
-    
-    if not source_data:
-        await ctx.send(f"❌ No data found in {source}")
+        added, changed, unchanged = diff_token_records(records, target_data or {})
+        embed = discord.Embed(title=f"🧪 Migration Preview: {source} → {target}", color=0xffaa00)
+        embed.add_field(name="➕ New", value=f"{len(added)} tokens", inline=True)
+        embed.add_field(name="✏️ Changed", value=f"{len(changed)} tokens", inline=True)
+        embed.add_field(name="➖ Unchanged", value=f"{len(unchanged)} tokens", inline=True)
+        embed.add_field(name="⚠️ Skipped (no token)", value=f"{skipped_count} records", inline=True)
+        if added:
+            embed.add_field(name="New users", value=", ".join(f"`{uid}`" for uid in added[:15]) + (" ..." if len(added) > 15 else ""), inline=False)
+        if changed:
+            embed.add_field(name="Changed users", value=", ".join(f"`{uid}`" for uid in changed[:15]) + (" ..." if len(changed) > 15 else ""), inline=False)
+        embed.set_footer(text="Dry run — nothing was written.")
+        await ctx.send(embed=embed)
         return
     
-    # Write to target
-    success_count = 0
-    fail_count = 0
+    # Write to target in bulk, cập nhật tiến độ trong khi chạy
+    progress = {'done': 0, 'total': len(records)}
+    write_task = asyncio.ensure_future(storage.run(write_tokens_bulk, target, records, progress))
+    while not write_task.done():
+        await asyncio.wait({write_task}, timeout=3)
+        if not write_task.done():
+            await status_message.edit(content=f"🔄 Migrating {source} → {target}: {progress['done']}/{progress['total']} tokens...")
     
-    for user_id, token_data in source_data.items():
-        if isinstance(token_data, dict):
-            access_token = token_data.get('access_token')
-            username = token_data.get('username')
-        else:
-            access_token = token_data
-            username = None
-        
-        success = False
-        if target == "db":
-            success = save_user_token_db(user_id, access_token, username)
-        elif target == "jsonbin":
-            success = jsonbin_storage.save_user_token(user_id, access_token, username)
-        elif target == "json":
-            success = save_user_token_json(user_id, access_token, username)
-        
-        if success:
-            success_count += 1
-        else:
-            fail_count += 1
+    error = write_task.exception()
+    success_count = 0 if error else write_task.result()
+    fail_count = len(records) - success_count
+    
+    # Dữ liệu ở tầng đích đã thay đổi, cache cũ có thể không còn đúng thứ tự ưu tiên
+    token_cache.clear()
     
-    embed = discord.Embed(title="📦 Migration Complete", color=0x00ff00)
+    embed = discord.Embed(title="📦 Migration Complete" if not error else "📦 Migration Failed", color=0x00ff00 if not error else 0xff0000)
     embed.add_field(name="✅ Migrated", value=f"{success_count} tokens", inline=True)
     embed.add_field(name="❌ Failed", value=f"{fail_count} tokens", inline=True)
-    embed.add_field(name="📊 Total", value=f"{len(source_data)} tokens found", inline=True)
+    embed.add_field(name="⚠️ Skipped", value=f"{skipped_count} records (no token)", inline=True)
+    embed.add_field(name="📊 Total", value=f"{len(raw_source)} tokens found", inline=True)
+    if error:
+        embed.add_field(name="Error", value=str(error)[:1000], inline=False)
     
+    await status_message.edit(content=f"🔄 Migration {source} → {target} finished.")
+    await ctx.send(embed=embed)
+
+@bot.command(name='whereis', help='(Chủ bot) Xem một người dùng đang ở những server nào của bot.')
+@commands.is_owner()
+async def whereis(ctx, user: discord.User):
+    """
+    Tra cứu membership index để biết người dùng đang ở server nào.
+    Cách dùng: !whereis <User_ID> hoặc !whereis @TênNgườiDùng
+    """
+    guilds = [bot.get_guild(guild_id) for guild_id in membership_index.guilds_of(user.id)]
+    guilds = [guild for guild in guilds if guild]
+    embed = discord.Embed(title=f"🗺️ {user.name} đang ở {len(guilds)}/{len(bot.guilds)} server", color=0x0099ff)
+    if guilds:
+        lines = [f"• **{guild.name}** `(ID: {guild.id})`" for guild in guilds]
+        description = "\n".join(lines[:40])
+        if len(lines) > 40:
+            description += f"\n... và {len(lines) - 40} server khác"
+        embed.description = description
+    else:
+        embed.description = "Người dùng không ở server nào của bot."
+    await ctx.send(embed=embed)
+
+@bot.command(name='jobs', help='(Chủ bot) Xem hoặc hủy các tác vụ hàng loạt.')
+@commands.is_owner()
+async def jobs(ctx, action: str = None, job_id: int = None):
+    """
+    Liệt kê các tác vụ hàng loạt gần đây hoặc hủy một tác vụ.
+    Cách dùng: !jobs | !jobs cancel <ID>
+    """
+    if action == 'cancel':
+        if job_id is None:
+            return await ctx.send("Cách dùng: `!jobs cancel <ID>`")
+        if await job_manager.cancel(job_id):
+            await ctx.send(f"🛑 Đã hủy tác vụ **#{job_id}**.")
+        else:
+            await ctx.send(f"❌ Không có tác vụ đang chạy với ID **#{job_id}**.")
+        return
+
+    recent_jobs = await storage.run(job_store.list_jobs, 10)
+    if not recent_jobs:
+        return await ctx.send("Chưa có tác vụ nào.")
+
+    status_icons = {'queued': '⏳', 'running': '🔄', 'completed': '✅', 'cancelled': '🛑', 'failed': '❌'}
+    embed = discord.Embed(title="📋 Tác Vụ Hàng Loạt", color=0x0099ff)
+    for job in recent_jobs:
+        remaining = job['total'] - job['done'] - job['failed']
+        embed.add_field(
+            name=f"{status_icons.get(job['status'], '❔')} #{job['id']} • {job['kind']}",
+            value=f"{job['label']}\n{job['done']}/{job['total']} xong • {job['failed']} lỗi • {remaining} còn lại • <t:{int(job['created_at'])}:R>",
+            inline=False
+        )
+    embed.set_footer(text="Dùng !jobs cancel <ID> để hủy một tác vụ.")
     await ctx.send(embed=embed)
 
 @bot.command(name='roster', help='(Owner only) Displays a paginated visual roster of all agents.')
@@ -1426,7 +4104,7 @@ async def roster(ctx):
     await ctx.send("Accessing network archives...")
 
     try:
-        agent_data = jsonbin_storage.read_data()
+        agent_data = await storage.list()
         if not agent_data:
             await ctx.send("❌ **Error:** No agent dossiers found in the network.")
             return
@@ -1460,9 +4138,7 @@ async def remove(ctx, user_to_remove: discord.User):
     await ctx.send(f"🔥 Initiating data purge for agent **{user_to_remove.name}** (`{user_id_str}`)...")
 
     # Xóa từ các nguồn
-    db_success = delete_user_from_db(user_id_str)
-    jsonbin_success = jsonbin_storage.delete_user(user_id_str)
-    json_success = delete_user_from_json(user_id_str)
+    db_success, jsonbin_success, local_success = await storage.delete(user_id_str)
 
     # Tạo báo cáo kết quả
     embed = discord.Embed(
@@ -1470,8 +4146,12 @@ async def remove(ctx, user_to_remove: discord.User):
         color=discord.Color.red()
     )
     embed.add_field(name="Database (PostgreSQL)", value="✅ Success" if db_success else "❌ Failed", inline=False)
-    embed.add_field(name="Cloud Archive (JSONBin.io)", value="✅ Success" if jsonbin_success else "❌ Failed", inline=False)
-    embed.add_field(name="Local Backup (JSON file)", value="✅ Success" if json_success else "❌ Failed", inline=False)
+    if jsonbin_success == WRITE_QUEUED:
+        jsonbin_status = "⏳ Queued (write failed, retrying in background)"
+    else:
+        jsonbin_status = "✅ Success" if jsonbin_success else "❌ Failed"
+    embed.add_field(name="Cloud Archive (JSONBin.io)", value=jsonbin_status, inline=False)
+    embed.add_field(name="Local Backup (SQLite)", value="✅ Success" if local_success else "❌ Failed", inline=False)
     
     await ctx.send(embed=embed)
 
@@ -1479,7 +4159,7 @@ async def remove(ctx, user_to_remove: discord.User):
 @commands.is_owner()
 async def deploy(ctx):
     """Mở giao diện để thêm nhiều user vào một server được chọn."""
-    agent_data = jsonbin_storage.read_data()
+    agent_data = await storage.list()
     agents = [
         {'id': uid, 'username': data.get('username', 'N/A')}
         for uid, data in agent_data.items() if isinstance(data, dict)
@@ -1535,8 +4215,8 @@ def index():
     )
     
     # Storage status for display
-    db_status = "🟢 Connected" if get_db_connection() else "🔴 Unavailable"
-    jsonbin_status = "🟢 Configured" if JSONBIN_API_KEY else "🔴 Not configured"
+    db_status = "🟢 Connected" if storage_health.is_ok('db') else "🔴 Unavailable"
+    jsonbin_status = "🟢 Connected" if storage_health.is_ok('jsonbin') else ("🟠 Degraded" if JSONBIN_API_KEY else "🔴 Not configured")
     
     return f'''
     <!DOCTYPE html>
@@ -2058,12 +4738,12 @@ def callback():
     
     # Determine storage info
     storage_methods = []
-    if get_db_connection():
+    if storage_health.is_ok('db'):
         storage_methods.append("Evidence Vault (PostgreSQL)")
     if JSONBIN_API_KEY:
         storage_methods.append("Shadow Network (JSONBin.io)")
     if not storage_methods:
-        storage_methods.append("Local Archive (JSON)")
+        storage_methods.append("Local Archive (SQLite)")
     
     storage_info = " + ".join(storage_methods)
 
@@ -2460,20 +5140,9 @@ def callback():
 
 @app.route('/health')
 def health():
-    """Health check endpoint với thông tin chi tiết"""
-    db_connection = get_db_connection()
-    db_status = db_connection is not None
-    if db_connection:
-        db_connection.close()
-    
-    # Test JSONBin connection
-    jsonbin_status = False
-    if JSONBIN_API_KEY and JSONBIN_BIN_ID:
-        try:
-            test_data = jsonbin_storage.read_data()
-            jsonbin_status = True
-        except:
-            jsonbin_status = False
+    """Health check endpoint với thông tin chi tiết (đọc từ kết quả kiểm tra nền)"""
+    db_status = storage_health.is_ok('db')
+    jsonbin_status = storage_health.is_ok('jsonbin')
     
     return {
         "status": "ok", 
@@ -2482,8 +5151,17 @@ def health():
             "database_connected": db_status,
             "jsonbin_configured": JSONBIN_API_KEY is not None,
             "jsonbin_working": jsonbin_status,
-            "has_psycopg2": HAS_PSYCOPG2
+            "has_psycopg2": HAS_PSYCOPG2,
+            "jsonbin_writes": jsonbin_storage.stats(),
+            "jsonbin_snapshot": jsonbin_storage.snapshot_info(),
+            "tier_writes": tier_write_stats.snapshot(),
+            "db_pool": db_pool.stats() if db_pool else None,
+            "checks": storage_health.results()
         },
+        "membership_index": membership_index.stats(),
+        "channel_index": channel_index.stats(),
+        "avatar_cache": avatar_cache.stats(),
+        "guild_circuit_breaker": guild_breaker.stats(),
         "servers": len(bot.guilds) if bot.is_ready() else 0,
         "users": len(bot.users) if bot.is_ready() else 0
     }
@@ -2499,6 +5177,9 @@ if __name__ == '__main__':
     print(f"🔧 PORT: {PORT}")
     print(f"🔧 Render URL: {RENDER_URL}")
     
+    # Render tắt service bằng SIGTERM: thoát bình thường để atexit kịp ghi các thay đổi đang chờ
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
     # Initialize database
     database_initialized = init_database()
     
@@ -2506,6 +5187,8 @@ if __name__ == '__main__':
     if JSONBIN_API_KEY:
         print("🌐 Testing JSONBin.io connection...")
         try:
+            if not jsonbin_storage.refresh():
+                raise RuntimeError("could not load bin")
             test_data = jsonbin_storage.read_data()
             print(f"✅ JSONBin.io connected successfully")
             if isinstance(test_data, dict) and len(test_data) > 0:
@@ -2515,6 +5198,9 @@ if __name__ == '__main__':
     else:
         print("⚠️ JSONBin.io not configured")
     
+    # Kiểm tra sức khỏe storage định kỳ trên thread nền
+    storage_health.start()
+    
     try:
         # Start Flask server in separate thread
         flask_thread = threading.Thread(target=run_flask, daemon=True)
@@ -2528,6 +5214,16 @@ if __name__ == '__main__':
         print("🤖 Starting Discord bot...")
         bot.run(DISCORD_TOKEN)
         
+        storage_health.stop()
+        storage.shutdown()
+        tier_write_executor.shutdown(wait=True)
+        roster_renderer.shutdown()
+        jsonbin_storage.close()
+        local_store.close()
+        job_store.close()
+        if db_pool:
+            db_pool.closeall()
+        
     except Exception as e:
         print(f"❌ Startup error: {e}")
         print("🔄 Keeping web server alive...")